@@ -51,6 +51,8 @@ DISPLAY_NAME = _("Tagging")
 STATUS_ID = "%s_id" % MODULE_NAME
 STATUS_NAME = "%s_name" % MODULE_NAME
 
+FILTER_TREE_ID = "%s_tree" % STATUS_ID
+
 DATETIME_010101 = datetime.datetime(1, 1, 1)
 
 
@@ -67,13 +69,15 @@ def get_resource(filename):
 class TagUpdate(object):
 
   TYPE_FULL = "Full"
+  TYPE_DELTA = "Delta"
 
 
-  def __init__(self, type_, timestamp, data):
+  def __init__(self, type_, timestamp, data, revision=None):
 
     self.type = type_
     self.timestamp = timestamp
     self.data = data
+    self.revision = revision
 
 
 # Section: Error
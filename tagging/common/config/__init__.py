@@ -90,6 +90,9 @@ OPTION_DEFAULTS_V2 = {
   "move_on_changes": False,
   "shared_limit_interval": 5,
   "move_after_recheck": False,
+  "autotag_regex_budget": 50,
+  "shared_limit_threshold": 1.0,
+  "shared_limit_threshold_ratio": 0.05,
 }
 
 TAG_DEFAULTS_V2 = {
@@ -105,6 +108,7 @@ TAG_DEFAULTS_V2 = {
   "max_connections": -1,
   "max_upload_slots": -1,
   "shared_limit": False,
+  "shared_limit_interval": 0,
 
   "queue_settings": False,
   "auto_managed": False,
@@ -35,6 +35,8 @@
 
 
 import re
+import sre_constants
+import sre_parse
 
 
 PROP_NAME = "Name"
@@ -91,6 +93,290 @@ FIELD_CASE = 2
 FIELD_QUERY = 3
 NUM_FIELDS = 4
 
+RULE_CACHE_SIZE = 1024
+
+_rule_cache = {}
+
+
+class CompiledRule(object):
+
+  __slots__ = ("prop", "op", "case", "query", "match")
+
+
+  def __init__(self, prop, op, case, query, match):
+
+    self.prop = prop
+    self.op = op
+    self.case = case
+    self.query = query
+    self.match = match
+
+
+#
+# Values are compared the way the re module sees them: byte strings as
+# latin-1 code points, and ignore case as per character lowercase.
+#
+
+def normalize_value(value, case):
+
+  if isinstance(value, str):
+    value = value.decode("latin-1")
+
+  if case == CASE_IGNORE:
+    value = value.lower()
+
+  return value
+
+
+def _compile_is(query, case):
+
+  query = normalize_value(query, case)
+
+  # Equivalent to '^query$', where '$' also matches before a final newline
+  def match(x):
+
+    x = normalize_value(x, case)
+    return x == query or (x[-1:] == u"\n" and x[:-1] == query)
+
+
+  return match
+
+
+def _compile_op(op, query, flags):
+
+  if op in (OP_IS, OP_IS_NOT) and flags & re.UNICODE:
+    case = CASE_IGNORE if flags & re.IGNORECASE else CASE_MATCH
+    match = _compile_is(query, case)
+
+    if op == OP_IS_NOT:
+      return lambda x: not match(x)
+
+    return match
+
+  if op == OP_CONTAINS_WORDS:
+    patterns = [re.compile(re.escape(x), flags) for x in query.split()]
+    return lambda x: all(p.search(x) for p in patterns)
+
+  if op == OP_MATCHES_REGEX:
+    pattern = re.compile(query, flags)
+  elif op in (OP_IS, OP_IS_NOT):
+    pattern = re.compile('^' + re.escape(query) + '$', flags)
+  elif op == OP_STARTS_WITH:
+    pattern = re.compile('^' + re.escape(query), flags)
+  elif op == OP_ENDS_WITH:
+    pattern = re.compile(re.escape(query) + '$', flags)
+  else:
+    pattern = re.compile(re.escape(query), flags)
+
+  if op in (OP_DOESNT_CONTAIN, OP_IS_NOT):
+    return lambda x: pattern.search(x) is None
+
+  return lambda x: pattern.search(x) is not None
+
+
+#
+# Compiled rules are cached by rule and flags. If strict is False, a rule
+# that fails to compile is returned as a rule that never matches.
+#
+
+def compile_rule(rule, use_unicode=True, strict=True):
+
+  prop, op, case, query = rule
+
+  key = (prop, op, case, query, use_unicode)
+  compiled = _rule_cache.get(key)
+
+  if compiled is None:
+    flags = re.UNICODE if use_unicode else 0
+
+    if case == CASE_IGNORE:
+      flags |= re.IGNORECASE
+
+    try:
+      match = _compile_op(op, query, flags)
+    except re.error:
+      if strict:
+        raise
+
+      return CompiledRule(prop, op, case, query, lambda x: False)
+
+    compiled = CompiledRule(prop, op, case, query, match)
+
+    if len(_rule_cache) >= RULE_CACHE_SIZE:
+      _rule_cache.clear()
+
+    _rule_cache[key] = compiled
+
+  return compiled
+
+
+def compile_rules(rules, use_unicode=True, strict=True):
+
+  return [compile_rule(x, use_unicode, strict) for x in rules]
+
+
+#
+# Detects nested unbounded repeats such as '(a+)+' or '(\w+\s?)*', where the
+# inner repeat can be split between iterations in exponentially many ways,
+# and repeated sequences such as '(x+x+)+' of single character repeats that
+# can match the same character. Ambiguous alternations such as '(a|aa)+'
+# and repeats of longer overlapping sequences are not detected; those are
+# left to the regex budget. Invalid patterns are not considered unsafe.
+#
+
+def is_unsafe_regex(pattern):
+
+  try:
+    parsed = sre_parse.parse(pattern)
+  except (re.error, sre_constants.error, OverflowError):
+    return False
+
+  return _has_nested_repeat(parsed)
+
+
+CATEGORY_FUNCS = {
+  sre_constants.CATEGORY_DIGIT: lambda x: x.isdigit(),
+  sre_constants.CATEGORY_NOT_DIGIT: lambda x: not x.isdigit(),
+  sre_constants.CATEGORY_SPACE: lambda x: x.isspace(),
+  sre_constants.CATEGORY_NOT_SPACE: lambda x: not x.isspace(),
+  sre_constants.CATEGORY_WORD: lambda x: x.isalnum() or x == u"_",
+  sre_constants.CATEGORY_NOT_WORD: lambda x: not (x.isalnum() or x == u"_"),
+}
+
+
+def _is_repeat(op, av):
+
+  return (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and
+    av[1] == sre_constants.MAXREPEAT)
+
+
+def _can_be_empty(items):
+
+  return sre_parse.SubPattern(sre_parse.Pattern(), items).getwidth()[0] == 0
+
+
+def _has_ambiguous_repeat(items):
+
+  items = list(items)
+
+  for i, (op, av) in enumerate(items):
+    if not _can_be_empty(items[:i] + items[i+1:]):
+      continue
+
+    if _is_repeat(op, av):
+      return True
+
+    if op == sre_constants.SUBPATTERN and _has_ambiguous_repeat(av[-1]):
+      return True
+
+    if op == sre_constants.BRANCH:
+      for branch in av[1]:
+        if _has_ambiguous_repeat(branch):
+          return True
+
+  return False
+
+
+def _matches_char(op, av, char):
+
+  if op == sre_constants.LITERAL:
+    return ord(char) == av
+
+  if op == sre_constants.NOT_LITERAL:
+    return ord(char) != av
+
+  if op == sre_constants.ANY:
+    return char != u"\n"
+
+  if op == sre_constants.CATEGORY:
+    return CATEGORY_FUNCS.get(av, lambda x: True)(char)
+
+  if op == sre_constants.IN:
+    negate = False
+    matched = False
+
+    for item_op, item_av in av:
+      if item_op == sre_constants.NEGATE:
+        negate = True
+      elif item_op == sre_constants.RANGE:
+        if item_av[0] <= ord(char) <= item_av[1]:
+          matched = True
+      elif _matches_char(item_op, item_av, char):
+        matched = True
+
+    return matched != negate
+
+  # Unknown items are assumed to match anything
+  return True
+
+
+def _can_overlap(items1, items2):
+
+  items1 = list(items1)
+  items2 = list(items2)
+
+  if len(items1) != 1 or len(items2) != 1:
+    return False
+
+  (op1, av1), (op2, av2) = items1[0], items2[0]
+
+  for i in range(256):
+    char = unichr(i)
+    if _matches_char(op1, av1, char) and _matches_char(op2, av2, char):
+      return True
+
+  return False
+
+
+def _has_overlapping_repeats(items):
+
+  items = list(items)
+
+  if len(items) == 1:
+    op, av = items[0]
+    if op == sre_constants.SUBPATTERN:
+      return _has_overlapping_repeats(av[-1])
+
+    if op == sre_constants.BRANCH:
+      return any(_has_overlapping_repeats(x) for x in av[1])
+
+  repeats = [i for i, (op, av) in enumerate(items) if _is_repeat(op, av)]
+
+  for i, first in enumerate(repeats):
+    for second in repeats[i+1:]:
+      if (_can_be_empty(items[first+1:second]) and
+          _can_overlap(items[first][1][2], items[second][1][2])):
+        return True
+
+  return False
+
+
+def _has_nested_repeat(items):
+
+  for op, av in items:
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+      if _is_repeat(op, av) and (_has_ambiguous_repeat(av[2]) or
+          _has_overlapping_repeats(av[2])):
+        return True
+
+      if _has_nested_repeat(av[2]):
+        return True
+    elif op in (sre_constants.SUBPATTERN, sre_constants.ASSERT,
+        sre_constants.ASSERT_NOT):
+      if _has_nested_repeat(av[-1]):
+        return True
+    elif op == sre_constants.BRANCH:
+      for branch in av[1]:
+        if _has_nested_repeat(branch):
+          return True
+
+  return False
+
+
+def clear_rule_cache():
+
+  _rule_cache.clear()
+
 
 #
 # props format:
@@ -98,7 +384,7 @@ NUM_FIELDS = 4
 #   "property_name": [property_values],
 # }
 #
-# rules format: [[property, op, case, query],]
+# rules format: [[property, op, case, query],] or [CompiledRule,]
 #
 
 def find_match(props, rules, match_all=False, use_unicode=True):
@@ -107,20 +393,15 @@ def find_match(props, rules, match_all=False, use_unicode=True):
     return False
 
   for rule in rules:
-    values = props.get(rule[FIELD_PROP]) or []
-    op_func = OP_FUNCS[rule[FIELD_OP]]
-
-    flags = re.UNICODE if use_unicode else 0
-
-    if rule[FIELD_CASE] == CASE_IGNORE:
-      flags |= re.IGNORECASE
+    if not isinstance(rule, CompiledRule):
+      rule = compile_rule(rule, use_unicode)
 
-    query = rule[FIELD_QUERY]
+    values = props.get(rule.prop) or []
 
     has_match = False
 
     for value in values:
-      if op_func(value, query, flags):
+      if rule.match(value):
         has_match = True
         break
 
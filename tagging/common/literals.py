@@ -79,3 +79,5 @@ ERR_INVALID_PARENT = "Invalid parent"
 ERR_INVALID_TAG_ID = "Invalid tag ID"
 ERR_INVALID_PARENT_ID = "Invalid parent ID"
 ERR_TAG_EXISTS = "Tag already exists"
+
+ERR_INVALID_JOB = "Invalid job"
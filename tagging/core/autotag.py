@@ -0,0 +1,779 @@
+#
+# autotag.py
+#
+# Copyright (C) 2014 Ratanak Lun <ratanakvlun@gmail.com>
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Linking this software with other modules is making a combined work
+# based on this software. Thus, the terms and conditions of the GNU
+# General Public License cover the whole combination.
+#
+# As a special exception, the copyright holders of this software give
+# you permission to link this software with independent modules to
+# produce a combined work, regardless of the license terms of these
+# independent modules, and to copy and distribute the resulting work
+# under terms of your choice, provided that you also meet, for each
+# linked module in the combined work, the terms and conditions of the
+# license of that module. An independent module is a module which is
+# not derived from or based on this software. If you modify this
+# software, you may extend this exception to your version of the
+# software, but you are not obligated to do so. If you do not wish to
+# do so, delete this exception statement from your version.
+#
+
+
+import bisect
+import collections
+import logging
+import time
+
+import tagging.common.config.autotag
+
+
+from tagging.common.config.autotag import normalize_value
+
+
+from tagging.common.config.autotag import (
+  PROPS, PROP_NAME, PROP_TRACKER, CASES,
+  OP_CONTAINS, OP_IS, OP_STARTS_WITH, OP_ENDS_WITH, OP_CONTAINS_WORDS,
+  OP_MATCHES_REGEX,
+)
+
+# Ops that can only match if their query occurs literally in the value
+LITERAL_OPS = (
+  OP_CONTAINS,
+  OP_STARTS_WITH,
+  OP_ENDS_WITH,
+  OP_CONTAINS_WORDS,
+)
+
+
+TRACKER_CACHE_SIZE = 4096
+
+# Number of evaluations of a tag after which its rules are reordered
+REORDER_INTERVAL = 1000
+MIN_DECIDE_RATE = 0.001
+
+# One in this many evaluations of a rule is timed; guarded regexes always are
+RULE_TIMING_INTERVAL = 32
+
+JOB_EVALUATING = "Evaluating"
+JOB_APPLYING = "Applying"
+JOB_DONE = "Done"
+JOB_CANCELLED = "Cancelled"
+JOB_FAILED = "Failed"
+
+
+log = logging.getLogger(__name__)
+
+
+# Sorts longer ids (usually deeper tags) first, then by value
+def get_priority_key(tag_id):
+
+  return (-len(tag_id), tag_id)
+
+
+def get_rule_key(rule):
+
+  return (rule.prop, rule.op, rule.case, rule.query)
+
+
+#
+# Aho-Corasick automaton that finds every pattern occurring in a string in
+# a single pass, returning the keys that were added with those patterns.
+#
+
+class PatternSet(object):
+
+  def __init__(self):
+
+    self._patterns = collections.defaultdict(set)
+    self._goto = None
+    self._fail = None
+    self._out = None
+
+
+  def __len__(self):
+
+    return len(self._patterns)
+
+
+  def add(self, pattern, key):
+
+    self._patterns[pattern].add(key)
+    self._goto = None
+
+
+  def clear(self):
+
+    self._patterns.clear()
+    self._goto = None
+
+
+  def search(self, text):
+
+    if self._goto is None:
+      self._build()
+
+    goto = self._goto
+    fail = self._fail
+    out = self._out
+
+    found = set()
+    state = 0
+
+    for ch in text:
+      while state and ch not in goto[state]:
+        state = fail[state]
+
+      state = goto[state].get(ch, 0)
+      if out[state]:
+        found.update(out[state])
+
+    return found
+
+
+  def _build(self):
+
+    goto = [{}]
+    out = [set()]
+
+    for pattern, keys in self._patterns.iteritems():
+      state = 0
+      for ch in pattern:
+        next_state = goto[state].get(ch)
+        if next_state is None:
+          next_state = len(goto)
+          goto[state][ch] = next_state
+          goto.append({})
+          out.append(set())
+
+        state = next_state
+
+      out[state].update(keys)
+
+    fail = [0] * len(goto)
+    queue = collections.deque(goto[0].itervalues())
+
+    while queue:
+      state = queue.popleft()
+
+      for ch, next_state in goto[state].iteritems():
+        queue.append(next_state)
+
+        f = fail[state]
+        while f and ch not in goto[f]:
+          f = fail[f]
+
+        fail[next_state] = goto[f].get(ch, 0)
+        out[next_state].update(out[fail[next_state]])
+
+    self._goto = goto
+    self._fail = fail
+    self._out = [frozenset(x) if x else None for x in out]
+
+
+#
+# Tracker rules only ever see the tracker URL, so their results and the
+# candidate tags for a URL are kept here and shared by every torrent using
+# that tracker. Candidates are recomputed when the patterns are rebuilt;
+# results are keyed by rule content and never go stale.
+#
+
+class TrackerEntry(object):
+
+  __slots__ = ("generation", "candidates", "results")
+
+
+  def __init__(self):
+
+    self.generation = -1
+    self.candidates = None
+    self.results = {}
+
+
+class AutotagEngine(object):
+
+  def __init__(self):
+
+    self._rules = {}
+    self._match_all = {}
+    self._definitions = {}
+
+    # (rule, key, stats) in the order rules are evaluated, and evaluations
+    # since reordered
+    self._ordered = {}
+    self._evaluations = {}
+    self._rule_stats = {}
+
+    self._order = []
+    self._always = set()
+    self._patterns = {}
+    self._exact = {}
+    self._stale = False
+    self._generation = 0
+
+    self._torrents = {}
+    self._tracker_index = {}
+
+    # Per tag results by torrent, valid for the tag's current rules, and
+    # per rule results by torrent, valid while the rule is used by any tag
+    self._states = {}
+    self._rule_results = {}
+
+    # Rule keys used by each tag, and the number of tags using each key
+    self._rule_keys = {}
+    self._rule_refs = {}
+
+    # Regex rules slower than the budget (in seconds) are disabled, as are
+    # unsafe ones, which are kept with an elapsed time of None
+    self._regex_budget = None
+    self._disabled_rules = {}
+
+
+  # Section: Public: Tags
+
+  def set_tag(self, tag_id, rules, match_all=False, enabled=True):
+
+    definition = (tuple(tuple(x) for x in rules), match_all)
+    if self._definitions.get(tag_id) != definition:
+      self._definitions[tag_id] = definition
+      self._states.pop(tag_id, None)
+
+    self._rules[tag_id] = tagging.common.config.autotag.compile_rules(
+      rules, strict=False)
+    self._match_all[tag_id] = match_all
+
+    # Unsafe regexes are kept in the tag's rules but never evaluated
+    for rule in self._rules[tag_id]:
+      if (rule.op == OP_MATCHES_REGEX and
+          tagging.common.config.autotag.is_unsafe_regex(rule.query)):
+        key = get_rule_key(rule)
+        if key not in self._disabled_rules:
+          log.warning("Disabling autotag rule %r: unsafe regex", list(key))
+          self._disabled_rules[key] = None
+
+    old_keys = self._rule_keys.get(tag_id, ())
+    self._rule_keys[tag_id] = [get_rule_key(x) for x in self._rules[tag_id]]
+    self._acquire_rule_keys(self._rule_keys[tag_id])
+    self._release_rule_keys(old_keys)
+
+    self._reorder_rules(tag_id)
+
+    key = get_priority_key(tag_id)
+    i = bisect.bisect_left(self._order, key)
+    present = i < len(self._order) and self._order[i] == key
+
+    if enabled and not present:
+      self._order.insert(i, key)
+    elif not enabled and present:
+      del self._order[i]
+
+    self._stale = True
+
+
+  def remove_tag(self, tag_id):
+
+    self._rules.pop(tag_id, None)
+    self._match_all.pop(tag_id, None)
+    self._definitions.pop(tag_id, None)
+    self._ordered.pop(tag_id, None)
+    self._evaluations.pop(tag_id, None)
+    self._states.pop(tag_id, None)
+    self._release_rule_keys(self._rule_keys.pop(tag_id, ()))
+
+    key = get_priority_key(tag_id)
+    i = bisect.bisect_left(self._order, key)
+    if i < len(self._order) and self._order[i] == key:
+      del self._order[i]
+
+    self._stale = True
+
+
+  # Section: Public: Torrents
+
+  def get_props(self, torrent_id, name, trackers):
+
+    cached = self._torrents.get(torrent_id)
+    if cached is None or cached[0] != name or list(cached[1]) != trackers:
+      if cached is not None:
+        self._clear_torrent_state(torrent_id)
+
+      cached = (name, tuple(trackers))
+      self._torrents[torrent_id] = cached
+
+    props = {
+      PROP_NAME: [name],
+      PROP_TRACKER: cached[1],
+    }
+
+    return props
+
+
+  def remove_torrent(self, torrent_id):
+
+    if self._torrents.pop(torrent_id, None) is not None:
+      self._clear_torrent_state(torrent_id)
+
+
+  def _clear_torrent_state(self, torrent_id):
+
+    for state in self._states.itervalues():
+      state.pop(torrent_id, None)
+
+    for results in self._rule_results.itervalues():
+      results.pop(torrent_id, None)
+
+
+  # Section: Public: Matching
+
+  #
+  # If torrent_id is given, each rule's result for the torrent is kept by
+  # rule, so a tag whose rules are edited only evaluates the changed rules.
+  #
+
+  def has_match(self, props, tag_id, torrent_id=None):
+
+    rules = self._ordered[tag_id]
+    match_all = self._match_all[tag_id]
+
+    if not rules:
+      return False
+
+    self._evaluations[tag_id] += 1
+    if self._evaluations[tag_id] >= REORDER_INTERVAL:
+      self._reorder_rules(tag_id)
+
+    for rule, key, stats in rules:
+      if key in self._disabled_rules:
+        has_match = False
+      elif torrent_id is None:
+        has_match = self._match_rule(props, rule, key, stats)
+      else:
+        results = self._rule_results.get(key)
+        if results is None:
+          results = self._rule_results[key] = {}
+
+        has_match = results.get(torrent_id)
+        if has_match is None:
+          has_match = self._match_rule(props, rule, key, stats)
+
+          # A result from the evaluation that disabled the rule is not kept
+          if key not in self._disabled_rules:
+            results[torrent_id] = has_match
+
+      if match_all and not has_match:
+        return False
+
+      if not match_all and has_match:
+        return True
+
+    return match_all
+
+
+  def _match_rule(self, props, rule, key, stats):
+
+    guarded = rule.op == OP_MATCHES_REGEX and self._regex_budget
+    timed = guarded or stats[0] % RULE_TIMING_INTERVAL == 0
+    stats[0] += 1
+
+    if not timed:
+      result = self._match_values(props, rule)
+      stats[1] += result
+      return result
+
+    start = time.time()
+    result = self._match_values(props, rule)
+    elapsed = time.time() - start
+
+    stats[1] += result
+    stats[2] += 1
+    stats[3] += elapsed
+    if elapsed > stats[4]:
+      stats[4] = elapsed
+
+    if guarded and elapsed > self._regex_budget:
+      self._disable_rule(key, elapsed)
+      return False
+
+    return result
+
+
+  def _match_values(self, props, rule):
+
+    if rule.prop == PROP_TRACKER:
+      key = (rule.op, rule.case, rule.query)
+
+      for url in props.get(PROP_TRACKER) or []:
+        results = self._get_tracker_entry(url).results
+        if key not in results:
+          results[key] = rule.match(url)
+
+        if results[key]:
+          return True
+    else:
+      for value in props.get(rule.prop) or []:
+        if rule.match(value):
+          return True
+
+    return False
+
+
+  #
+  # Same as has_match, but remembers the result until the tag's rules or the
+  # torrent's properties change. props must come from get_props.
+  #
+
+  def has_torrent_match(self, torrent_id, props, tag_id):
+
+    state = self._states.get(tag_id)
+    if state is None:
+      state = self._states[tag_id] = {}
+
+    result = state.get(torrent_id)
+    if result is None:
+      result = state[torrent_id] = self.has_match(props, tag_id, torrent_id)
+
+    return result
+
+
+  def find_match(self, props):
+
+    for tag_id in self.get_candidates(props):
+      if self.has_match(props, tag_id):
+        return tag_id
+
+    return None
+
+
+  def get_candidates(self, props):
+
+    if self._stale:
+      self._build_patterns()
+
+    candidates = set(self._always)
+
+    for prop in PROPS:
+      for value in props.get(prop) or []:
+        if prop == PROP_TRACKER:
+          entry = self._get_tracker_entry(value)
+          if entry.generation != self._generation:
+            entry.candidates = self._search_value(prop, value)
+            entry.generation = self._generation
+
+          candidates.update(entry.candidates)
+        else:
+          candidates.update(self._search_value(prop, value))
+
+    return sorted(candidates, key=get_priority_key)
+
+
+  def _search_value(self, prop, value):
+
+    found = set()
+
+    for case in CASES:
+      patterns = self._patterns.get((prop, case))
+      index = self._exact.get((prop, case))
+
+      if not patterns and not index:
+        continue
+
+      normalized = normalize_value(value, case)
+
+      if patterns:
+        found.update(patterns.search(normalized))
+
+      if index:
+        found.update(index.get(normalized, ()))
+
+        # "is" also matches a value with a single trailing newline
+        if normalized[-1:] == u"\n":
+          found.update(index.get(normalized[:-1], ()))
+
+    return found
+
+
+  # Section: Trackers
+
+  def _get_tracker_entry(self, url):
+
+    entry = self._tracker_index.get(url)
+    if entry is None:
+      if len(self._tracker_index) >= TRACKER_CACHE_SIZE:
+        self._tracker_index.clear()
+
+      entry = TrackerEntry()
+      self._tracker_index[url] = entry
+
+    return entry
+
+
+  # Section: Public: Regex Guard
+
+  def set_regex_budget(self, budget):
+
+    if budget != self._regex_budget:
+      self._regex_budget = budget
+
+      # Rules disabled for being unsafe stay disabled
+      timed = [k for k, v in self._disabled_rules.iteritems() if v is not None]
+      if timed:
+        for key in timed:
+          del self._disabled_rules[key]
+          self._rule_results.pop(key, None)
+
+        self._states.clear()
+
+
+  def get_disabled_rules(self):
+
+    rules = []
+
+    for key, elapsed in self._disabled_rules.iteritems():
+      rules.append({
+        "rule": list(key),
+        "unsafe": elapsed is None,
+        "elapsed": elapsed,
+      })
+
+    return rules
+
+
+  def _disable_rule(self, key, elapsed):
+
+    log.warning("Disabling autotag rule %r: took %.3fs (budget %.3fs)",
+      list(key), elapsed, self._regex_budget)
+
+    self._disabled_rules[key] = elapsed
+
+    # Results computed with the rule enabled no longer apply
+    self._states.clear()
+
+
+  # Section: Public: Rule Statistics
+
+  def get_rule_stats(self):
+
+    stats = []
+
+    for key, (count, hits, timed, total, max_time) in \
+        self._rule_stats.iteritems():
+      stats.append({
+        "rule": list(key),
+        "count": count,
+        "hits": hits,
+        "hit_rate": float(hits)/count if count else 0.0,
+        "average": total/timed if timed else 0.0,
+        "max": max_time,
+      })
+
+    return stats
+
+
+  #
+  # Rules are combined with plain and/or, so their order doesn't change the
+  # result. Evaluating first the rules with the lowest cost per decision
+  # (a hit for match any, a miss for match all) minimizes the expected cost.
+  # Rules without statistics go first so they get measured.
+  #
+
+  def _reorder_rules(self, tag_id):
+
+    def expected_cost(entry):
+
+      count, hits, timed, total = entry[2][:4]
+      if not timed:
+        return 0.0
+
+      decided = count - hits if match_all else hits
+      rate = max(float(decided)/count, MIN_DECIDE_RATE)
+
+      return total/timed/rate
+
+
+    match_all = self._match_all[tag_id]
+    entries = []
+
+    # [evaluations, hits, timed evaluations, total time, max time]
+    for rule in self._rules[tag_id]:
+      key = get_rule_key(rule)
+      stats = self._rule_stats.get(key)
+      if stats is None:
+        stats = self._rule_stats[key] = [0, 0, 0, 0.0, 0.0]
+
+      entries.append((rule, key, stats))
+
+    self._ordered[tag_id] = sorted(entries, key=expected_cost)
+    self._evaluations[tag_id] = 0
+
+
+  def _acquire_rule_keys(self, keys):
+
+    for key in keys:
+      self._rule_refs[key] = self._rule_refs.get(key, 0) + 1
+
+
+  # Results of a rule are dropped once no tag uses it
+  def _release_rule_keys(self, keys):
+
+    for key in keys:
+      self._rule_refs[key] -= 1
+      if not self._rule_refs[key]:
+        del self._rule_refs[key]
+        self._rule_results.pop(key, None)
+
+
+  # Section: Patterns
+
+  def _build_patterns(self):
+
+    self._always.clear()
+    self._patterns = {}
+    self._exact = {}
+
+    for key in self._order:
+      tag_id = key[1]
+      literals = self._get_required_literals(tag_id)
+
+      if literals is None:
+        self._always.add(tag_id)
+        continue
+
+      for exact, prop, case, literal in literals:
+        if exact:
+          index = self._exact.setdefault((prop, case), {})
+          index.setdefault(literal, set()).add(tag_id)
+        else:
+          if (prop, case) not in self._patterns:
+            self._patterns[prop, case] = PatternSet()
+
+          self._patterns[prop, case].add(literal, tag_id)
+
+    self._stale = False
+    self._generation += 1
+
+
+  #
+  # Returns literals of which at least one must occur (or, for exact
+  # literals, equal a value) for the tag to match, or None if the tag has to
+  # be evaluated for every torrent.
+  #
+
+  def _get_required_literals(self, tag_id):
+
+    literals = []
+
+    for rule in self._rules[tag_id]:
+      literal = self._get_rule_literal(rule)
+
+      if self._match_all[tag_id]:
+        # Any single rule that must match is enough to filter on, so
+        # prefer exact literals, then the longest
+        if literal is not None:
+          if (not literals or (literal[0], len(literal[3])) >
+              (literals[0][0], len(literals[0][3]))):
+            literals = [literal]
+      elif literal is None:
+        return None
+      else:
+        literals.append(literal)
+
+    if self._match_all[tag_id] and self._rules[tag_id] and not literals:
+      return None
+
+    return literals
+
+
+  def _get_rule_literal(self, rule):
+
+    if rule.op == OP_IS:
+      return (True, rule.prop, rule.case, normalize_value(rule.query,
+        rule.case))
+
+    if rule.op not in LITERAL_OPS:
+      return None
+
+    if rule.op == OP_CONTAINS_WORDS:
+      words = rule.query.split()
+      query = max(words, key=len) if words else ""
+    else:
+      query = rule.query
+
+    if not query:
+      return None
+
+    return (False, rule.prop, rule.case, normalize_value(query, rule.case))
+
+
+#
+# Tracks an autotag run over torrent_ids. The core drives it in-process as a
+# cooperative task, evaluating then applying one torrent per step; it is
+# cancelled if its tag is removed or moved.
+#
+
+class AutotagJob(object):
+
+  def __init__(self, job_id, tag_id, torrent_ids):
+
+    self.id = job_id
+    self.tag_id = tag_id
+    self.torrent_ids = torrent_ids
+    self.total = len(torrent_ids)
+    self.matched = []
+
+    self.state = JOB_EVALUATING
+    self.evaluated = 0
+    self.applied = 0
+    self.error = None
+
+    self.started = time.time()
+    self.finished = None
+
+    self.task = None
+
+
+  def is_active(self):
+
+    return self.state in (JOB_EVALUATING, JOB_APPLYING)
+
+
+  def finish(self, state, error=None):
+
+    self.state = state
+    self.error = error
+    self.finished = time.time()
+
+    self.task = None
+    self.torrent_ids = None
+
+
+  def get_status(self):
+
+    end = self.finished or time.time()
+
+    status = {
+      "id": self.id,
+      "tag_id": self.tag_id,
+      "state": self.state,
+      "total": self.total,
+      "evaluated": self.evaluated,
+      "matched": len(self.matched),
+      "applied": self.applied,
+      "elapsed": end - self.started,
+      "error": self.error,
+    }
+
+    return status
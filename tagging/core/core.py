@@ -34,18 +34,23 @@
 #
 
 
+import array
 import cPickle
+import collections
 import copy
 import datetime
 import logging
 import os
+import time
 
 import twisted.internet
+import twisted.internet.task
 
 import deluge.common
 import deluge.component
 import deluge.configmanager
 import deluge.core.rpcserver
+import deluge.event
 
 import tagging.common
 import tagging.common.config
@@ -53,19 +58,25 @@ import tagging.common.config.convert
 import tagging.common.config.autotag
 import tagging.common.tag
 
+import tagging.core.autotag
 import tagging.core.config
 import tagging.core.config.convert
+import tagging.core.tag_index
 
 
 from deluge.plugins.pluginbase import CorePluginBase
 
 from tagging.common import TagUpdate
 from tagging.common import TaggingError
+from tagging.core.autotag import AutotagEngine
+from tagging.core.autotag import AutotagJob
+from tagging.core.tag_index import TagIndex
 
 
 from tagging.common.literals import (
   ERR_CORE_NOT_INITIALIZED,
   ERR_INVALID_TAG, ERR_INVALID_PARENT, ERR_TAG_EXISTS,
+  ERR_INVALID_JOB,
 )
 
 CORE_CONFIG = "%s.conf" % tagging.common.MODULE_NAME
@@ -73,16 +84,80 @@ DELUGE_CORE_CONFIG = "core.conf"
 
 CONFIG_SAVE_INTERVAL = 60*2
 
+# Number of distinct tags kept in the changelog used for delta updates
+CHANGELOG_SIZE = 1000
+
+CHANGE_COUNT = 1
+CHANGE_TAG = 2
+
+# Delay used to coalesce bursts of changes into one TaggingChangedEvent
+CHANGE_EVENT_DELAY = 0.5
+
+# Revision tokens sent to clients are "<prefix><session id>:<revision>"
+REVISION_PREFIX = "rev:"
+
+# Forms in which tag updates are served and cached
+UPDATE_FORM_PICKLE = "pickle"
+UPDATE_FORM_DICT = "dict"
+
+# libtorrent states that Deluge reports as Downloading or Seeding
+ACTIVE_LT_STATES = (
+  "Downloading Metadata",
+  "Downloading",
+  "Finished",
+  "Seeding",
+)
+
+# Number of finished autotag jobs kept for status queries
+AUTOTAG_JOB_HISTORY = 10
+
+# Number of matched torrent ids returned by an autotag test run
+AUTOTAG_SAMPLE_SIZE = 20
+
+# Shared limit tags are spread over their interval and updated in small
+# batches so that no single reactor callback recomputes all of them
+SHARED_LIMIT_TICK_INTERVAL = 0.5
+SHARED_LIMIT_TAGS_PER_TICK = 8
+SHARED_LIMIT_TICK_BUDGET = 0.02
+
+# Deluge torrent option keys in the order they are applied
+TORRENT_OPTION_KEYS = (
+  "move_completed",
+  "move_completed_path",
+  "prioritize_first_last_pieces",
+  "max_download_speed",
+  "max_upload_speed",
+  "max_connections",
+  "max_upload_slots",
+  "auto_managed",
+  "stop_at_ratio",
+  "stop_ratio",
+  "remove_at_ratio",
+)
+
+TORRENT_OPTION_SETTERS = {
+  "move_completed": "set_move_completed",
+  "move_completed_path": "set_move_completed_path",
+  "prioritize_first_last_pieces": "set_prioritize_first_last",
+  "max_download_speed": "set_max_download_speed",
+  "max_upload_speed": "set_max_upload_speed",
+  "max_connections": "set_max_connections",
+  "max_upload_slots": "set_max_upload_slots",
+  "auto_managed": "set_auto_managed",
+  "stop_at_ratio": "set_stop_at_ratio",
+  "stop_ratio": "set_stop_ratio",
+  "remove_at_ratio": "set_remove_at_ratio",
+}
+
 
 log = logging.getLogger(__name__)
 
 
-def cmp_length_then_value(x, y):
+class TaggingChangedEvent(deluge.event.DelugeEvent):
 
-  if len(x) > len(y): return -1
-  if len(x) < len(y): return 1
+  def __init__(self, revision):
 
-  return cmp(x, y)
+    self._args = [revision]
 
 
 def check_init(func):
@@ -99,6 +174,32 @@ def check_init(func):
   return wrap
 
 
+#
+# Computes per-torrent limits (KiB/s) for a shared limit over an array of
+# payload rates (B/s). Above the shared limit, usage is deducted by share;
+# below it, active torrents get a slice of the unused bandwidth and
+# inactive ones are given the whole limit.
+#
+
+def allocate_shared_limit(rates, shared_limit):
+
+  if shared_limit < 0.0:
+    return array.array("d", [-1.0]) * len(rates)
+
+  kib_rates = array.array("d", [x / 1024.0 for x in rates])
+  rate_sum = sum(rates) / 1024.0
+  diff = rate_sum - shared_limit
+
+  if diff >= 0.0:
+    limits = [x - (x / rate_sum * diff) for x in kib_rates]
+  else:
+    num_active = sum(1 for x in rates if x > 0.0)
+    unused = abs(diff) / num_active if num_active else 0.0
+    limits = [x + unused if x > 0.0 else shared_limit for x in kib_rates]
+
+  return array.array("d", [0.1 if x < 0.1 else x for x in limits])
+
+
 class Core(CorePluginBase):
 
   # Section: Initialization
@@ -110,6 +211,37 @@ class Core(CorePluginBase):
     self._initialized = False
     self._config = None
 
+    self._pending_options = []
+    self._options_task = None
+    self._change_event_call = None
+    self._autotag_jobs = collections.OrderedDict()
+    self._next_job_id = 1
+    self._options_progress = {
+      "total": 0,
+      "applied": 0,
+    }
+
+    self._stats = {
+      "torrent_options": {
+        "issued": 0,
+        "skipped": 0,
+      },
+      "shared_limit": {
+        "issued": 0,
+        "suppressed": 0,
+        "ticks": 0,
+        "updated": 0,
+        "deferred": 0,
+        "tick_time_last": 0.0,
+        "tick_time_max": 0.0,
+        "tick_time_total": 0.0,
+      },
+      "update_cache": {
+        "hits": 0,
+        "misses": 0,
+      },
+    }
+
 
   def enable(self):
 
@@ -139,29 +271,56 @@ class Core(CorePluginBase):
     self._tags = self._config["tags"]
     self._mappings = self._config["mappings"]
 
-    self._sorted_tags = {}
-
     self._timestamp = {
       "tags_changed": tagging.common.DATETIME_010101,
       "mappings_changed": tagging.common.DATETIME_010101,
-      "tags_sorted": tagging.common.DATETIME_010101,
       "last_saved": tagging.common.DATETIME_010101,
     }
 
     self._torrents = deluge.component.get("TorrentManager").torrents
-
-    self._build_tag_index()
-    self._remove_orphans()
-
-    self._normalize_data()
-    self._normalize_mappings()
-    self._normalize_move_modes()
-
-    self._build_fullname_index()
-    self._build_shared_limit_index()
+    self._untagged = set()
+    self._active = set()
+    self._active_lt_states = set(deluge.common.LT_TORRENT_STATE[x] for x in
+      ACTIVE_LT_STATES)
+    self._shared_limit_due = {}
+    self._autotag = AutotagEngine()
+
+    # Tokens carry a per-session id so that revisions held by clients from
+    # a previous session are never mistaken for ones from this session
+    self._session_id = os.urandom(8).encode("hex")
+    self._revision = 0
+    self._changelog = collections.OrderedDict()
+    self._changelog_floor = self._revision
+
+    self._update_cache = {}
+    self._update_cache_revision = None
+
+    phases = (
+      self._build_tag_index,
+      self._remove_orphans,
+      self._normalize_data,
+      self._normalize_mappings,
+      self._build_untagged_index,
+      self._build_active_index,
+      self._normalize_move_modes,
+      self._build_fullname_index,
+      self._build_shared_limit_index,
+    )
+
+    timings = []
+
+    for phase in phases:
+      start = time.time()
+      phase()
+      timings.append((phase.__name__, time.time()-start))
+
+    log.debug("Startup phases (%s tags, %s mappings): %s", len(self._tags),
+      len(self._mappings), ", ".join("%s: %.3fs" % x for x in timings))
 
     deluge.component.get("FilterManager").register_filter(
       tagging.common.STATUS_ID, self.filter_by_tag)
+    deluge.component.get("FilterManager").register_filter(
+      tagging.common.FILTER_TREE_ID, self.filter_by_tag_tree)
 
     deluge.component.get("CorePluginManager").register_status_field(
       tagging.common.STATUS_NAME, self.get_torrent_tag_name)
@@ -176,8 +335,15 @@ class Core(CorePluginBase):
     deluge.component.get("AlertManager").register_handler(
       "torrent_finished_alert", self.on_torrent_finished)
 
+    for alert_type in ("state_changed_alert", "torrent_paused_alert",
+        "torrent_resumed_alert"):
+      deluge.component.get("AlertManager").register_handler(
+        alert_type, self.on_torrent_state_changed)
+
     self._initialized = True
 
+    self._start_options_task()
+
     twisted.internet.reactor.callLater(1, self._save_config_update_loop)
     twisted.internet.reactor.callLater(1, self._shared_limit_update_loop)
 
@@ -200,38 +366,24 @@ class Core(CorePluginBase):
 
   def _build_tag_index(self):
 
-    def build_tag_entry(tag_id):
-
-      children = []
-      torrents = []
-
-      for id in self._tags:
-        if id == tag_id:
-          continue
-
-        if tagging.common.tag.get_parent_id(id) == tag_id:
-          children.append(id)
-
-      for id in self._mappings:
-        if self._mappings[id] == tag_id:
-          torrents.append(id)
-
-      tag_entry = {
-        "children": children,
-        "torrents": torrents,
-      }
-
-      return tag_entry
-
-
     index = {}
 
-    index[tagging.common.tag.ID_NULL] = build_tag_entry(
-      tagging.common.tag.ID_NULL)
+    index[tagging.common.tag.ID_NULL] = TagIndex()
 
     for id in self._tags:
       if id not in tagging.common.tag.RESERVED_IDS:
-        index[id] = build_tag_entry(id)
+        index[id] = TagIndex(depth=tagging.core.tag_index.get_depth(id))
+
+    # Bucket children by parent and torrents by tag in a single pass each
+    for id in index:
+      if id != tagging.common.tag.ID_NULL:
+        parent_id = tagging.common.tag.get_parent_id(id)
+        if parent_id in index:
+          index[parent_id].add_child(id)
+
+    for torrent_id, tag_id in self._mappings.iteritems():
+      if tag_id in index:
+        index[tag_id].add_torrent(torrent_id)
 
     self._index = index
 
@@ -254,6 +406,7 @@ class Core(CorePluginBase):
 
     self._normalize_options(self._prefs["options"])
     self._normalize_tag_options(self._prefs["tag"])
+    self._update_regex_budget()
 
     for id in tagging.common.tag.RESERVED_IDS:
       if id in self._tags:
@@ -262,20 +415,93 @@ class Core(CorePluginBase):
     for id in self._tags:
       self._normalize_tag_options(self._tags[id]["options"],
         self._prefs["tag"])
+      self._compile_autotag_rules(id)
 
 
   def _normalize_mappings(self):
 
+    # Torrent options are applied later by the options task so that the
+    # reactor isn't blocked by libtorrent calls on large libraries
+    pending = []
+
     for id in self._mappings.keys():
       if id in self._torrents:
+        pending.append(id)
+
         if self._mappings[id] in self._tags:
-          self._apply_torrent_options(id)
           continue
-        else:
-          self._reset_torrent_options(id)
 
       self._remove_torrent_tag(id)
 
+    self._pending_options = pending
+
+
+  def _start_options_task(self):
+
+    def apply_options(torrent_ids):
+
+      for id in torrent_ids:
+        if id in self._torrents:
+          self._apply_torrent_options(id)
+
+        self._options_progress["applied"] += 1
+        yield None
+
+
+    def on_done(result, start):
+
+      log.debug("Applied torrent options to %s torrents in %.3fs",
+        self._options_progress["applied"], time.time()-start)
+
+      self._options_task = None
+
+
+    def on_error(failure):
+
+      self._options_task = None
+
+      if not failure.check(twisted.internet.task.TaskStopped):
+        return failure
+
+
+    pending = self._pending_options
+    self._pending_options = []
+
+    self._options_progress["total"] = len(pending)
+    self._options_progress["applied"] = 0
+
+    if not pending:
+      return
+
+    self._options_task = twisted.internet.task.cooperate(
+      apply_options(pending))
+
+    deferred = self._options_task.whenDone()
+    deferred.addCallback(on_done, time.time())
+    deferred.addErrback(on_error)
+
+
+  def _build_untagged_index(self):
+
+    self._untagged = set(x for x in self._torrents if x not in self._mappings)
+
+
+  def _build_active_index(self):
+
+    try:
+      session = deluge.component.get("Core").session
+      lt_statuses = session.get_torrent_status(lambda x: not x.paused, 0)
+    except (AttributeError, TypeError):
+      self._active = set(x for x in self._torrents if
+        self._torrents[x].get_status(["state"])["state"] in
+        ("Seeding", "Downloading"))
+      return
+
+    active = set(str(x.handle.info_hash()) for x in lt_statuses if
+      self._is_active_lt_status(x))
+
+    self._active = set(x for x in active if x in self._torrents)
+
 
   def _normalize_move_modes(self):
 
@@ -314,6 +540,17 @@ class Core(CorePluginBase):
 
     self._initialized = False
 
+    if self._options_task:
+      self._options_task.stop()
+
+    for job in self._autotag_jobs.values():
+      self._cancel_autotag_job(job)
+
+    if self._change_event_call and self._change_event_call.active():
+      self._change_event_call.cancel()
+
+    self._change_event_call = None
+
     deluge.component.get("EventManager").deregister_event_handler(
       "TorrentAddedEvent", self.on_torrent_added)
     deluge.component.get("EventManager").deregister_event_handler(
@@ -321,16 +558,19 @@ class Core(CorePluginBase):
 
     deluge.component.get("AlertManager").deregister_handler(
       self.on_torrent_finished)
+    deluge.component.get("AlertManager").deregister_handler(
+      self.on_torrent_state_changed)
 
     deluge.component.get("CorePluginManager").deregister_status_field(
       tagging.common.STATUS_ID)
     deluge.component.get("CorePluginManager").deregister_status_field(
       tagging.common.STATUS_NAME)
 
-    if (tagging.common.STATUS_ID in
-        deluge.component.get("FilterManager").registered_filters):
-      deluge.component.get("FilterManager").deregister_filter(
-        tagging.common.STATUS_ID)
+    for filter_id in (tagging.common.STATUS_ID,
+        tagging.common.FILTER_TREE_ID):
+      if (filter_id in
+          deluge.component.get("FilterManager").registered_filters):
+        deluge.component.get("FilterManager").deregister_filter(filter_id)
 
     self._rpc_deregister(tagging.common.PLUGIN_NAME)
 
@@ -371,12 +611,30 @@ class Core(CorePluginBase):
   def _shared_limit_update_loop(self):
 
     if self._initialized:
-      for id in self._shared_limit_index:
-        if id in self._tags:
-          self._do_update_shared_limit(id)
-
-      twisted.internet.reactor.callLater(
-        self._prefs["options"]["shared_limit_interval"],
+      start = time.time()
+      stats = self._stats["shared_limit"]
+
+      tag_ids = self._get_due_shared_limit_tags(start)
+
+      # Each tag reads the rates of its own active members, so the budget
+      # is charged per tag for both reading and updating
+      for i, id in enumerate(tag_ids):
+        if i and time.time() - start > SHARED_LIMIT_TICK_BUDGET:
+          stats["deferred"] += len(tag_ids) - i
+          break
+
+        self._do_update_shared_limit(id)
+        self._reschedule_shared_limit(id, start)
+        stats["updated"] += 1
+
+      elapsed = time.time() - start
+      stats["ticks"] += 1
+      stats["tick_time_last"] = elapsed
+      stats["tick_time_total"] += elapsed
+      if elapsed > stats["tick_time_max"]:
+        stats["tick_time_max"] = elapsed
+
+      twisted.internet.reactor.callLater(SHARED_LIMIT_TICK_INTERVAL,
         self._shared_limit_update_loop)
 
 
@@ -388,12 +646,38 @@ class Core(CorePluginBase):
     return self._initialized
 
 
+  @deluge.core.rpcserver.export
+  def get_init_status(self):
+
+    status = {
+      "initialized": self._initialized,
+      "options_total": self._options_progress["total"],
+      "options_applied": self._options_progress["applied"],
+      "options_pending": self._options_task is not None,
+    }
+
+    return status
+
+
   @deluge.core.rpcserver.export
   def get_daemon_info(self):
 
     return self._get_daemon_info()
 
 
+  @deluge.core.rpcserver.export
+  @check_init
+  def get_stats(self):
+
+    stats = copy.deepcopy(self._stats)
+    stats["autotag"] = {
+      "disabled_rules": self._autotag.get_disabled_rules(),
+      "rule_stats": self._autotag.get_rule_stats(),
+    }
+
+    return stats
+
+
   # Section: Public API: Preferences
 
   @deluge.core.rpcserver.export
@@ -417,6 +701,8 @@ class Core(CorePluginBase):
     self._normalize_tag_options(prefs["tag"])
     self._prefs["tag"].update(prefs["tag"])
 
+    self._update_regex_budget()
+
     self._config.save()
     self._timestamp["last_saved"] = datetime.datetime.now()
 
@@ -485,18 +771,9 @@ class Core(CorePluginBase):
   @check_init
   def get_tag_updates(self, since=None):
 
-    if since:
-      t = cPickle.loads(since)
-    else:
-      t = tagging.common.DATETIME_010101
-
-    last_changed = max(self._timestamp["tags_changed"],
-      self._timestamp["mappings_changed"])
-
-    if t <= last_changed:
-      u = TagUpdate(TagUpdate.TYPE_FULL, datetime.datetime.now(),
-        self._get_tags_data())
-      return cPickle.dumps(u)
+    key = self._get_update_key(since)
+    if key:
+      return self._get_cached_update(UPDATE_FORM_PICKLE, key)
     else:
       return None
 
@@ -506,23 +783,9 @@ class Core(CorePluginBase):
   @check_init
   def get_tag_updates_dict(self, since=None):
 
-    if since:
-      t = cPickle.loads(since)
-    else:
-      t = tagging.common.DATETIME_010101
-
-    last_changed = max(self._timestamp["tags_changed"],
-      self._timestamp["mappings_changed"])
-
-    if t <= last_changed:
-      u = TagUpdate(TagUpdate.TYPE_FULL, datetime.datetime.now(),
-        self._get_tags_data())
-
-      return {
-        "type": u.type,
-        "timestamp": cPickle.dumps(u.timestamp),
-        "data": u.data
-      }
+    key = self._get_update_key(since)
+    if key:
+      return self._get_cached_update(UPDATE_FORM_DICT, key)
     else:
       return None
 
@@ -622,7 +885,38 @@ class Core(CorePluginBase):
     if tag_id not in self._tags:
       raise TaggingError(ERR_INVALID_TAG)
 
-    self._set_tag_options(tag_id, options_in, apply_to_all)
+    return self._set_tag_options(tag_id, options_in, apply_to_all)
+
+
+  @deluge.core.rpcserver.export
+  @check_init
+  def get_autotag_diff(self, tag_id, apply_to_all=False):
+
+    log.debug("Getting autotag diff for %r", tag_id)
+
+    if tag_id not in self._tags:
+      raise TaggingError(ERR_INVALID_TAG)
+
+    return self._start_autotag_diff(tag_id, apply_to_all)
+
+
+  @deluge.core.rpcserver.export
+  @check_init
+  def test_autotag_rules(self, rules, match_all=False):
+
+    log.debug("Testing autotag rules")
+
+    return self._test_autotag_rules(rules, match_all)
+
+
+  @deluge.core.rpcserver.export
+  @check_init
+  def get_autotag_job(self, job_id):
+
+    if job_id not in self._autotag_jobs:
+      raise TaggingError(ERR_INVALID_JOB)
+
+    return self._autotag_jobs[job_id].get_status()
 
 
   # Section: Public API: Torrent-Tag
@@ -656,9 +950,11 @@ class Core(CorePluginBase):
       raise TaggingError(ERR_INVALID_TAG)
 
     torrent_ids = [x for x in set(torrent_ids) if x in self._torrents]
+    changed = False
 
     for id in torrent_ids:
-      self._set_torrent_tag(id, tag_id)
+      if self._set_torrent_tag(id, tag_id):
+        changed = True
 
     do_move = False
 
@@ -672,7 +968,7 @@ class Core(CorePluginBase):
     if do_move:
       self._do_move_completed(torrent_ids)
 
-    if torrent_ids:
+    if changed:
       self._timestamp["mappings_changed"] = datetime.datetime.now()
 
 
@@ -681,23 +977,38 @@ class Core(CorePluginBase):
   @check_init
   def on_torrent_added(self, torrent_id):
 
+    self._log_count_change(tagging.common.tag.ID_ALL)
+    self._untagged.add(torrent_id)
+    self._update_active_torrent(torrent_id)
+
     tag_id = self._find_autotag_match(torrent_id)
     if tag_id:
       self._set_torrent_tag(torrent_id, tag_id)
       log.debug("Setting torrent %r to tag %r", torrent_id, tag_id)
 
       self._timestamp["mappings_changed"] = datetime.datetime.now()
+    else:
+      self._log_count_change(tagging.common.tag.ID_NONE)
 
 
   @check_init
   def on_torrent_removed(self, torrent_id):
 
+    self._autotag.remove_torrent(torrent_id)
+    self._log_count_change(tagging.common.tag.ID_ALL)
+
+    # Only removing a tagged torrent changes the mappings
     if torrent_id in self._mappings:
       tag_id = self._mappings[torrent_id]
       self._remove_torrent_tag(torrent_id)
       log.debug("Removing torrent %r from tag %r", torrent_id, tag_id)
 
-    self._timestamp["mappings_changed"] = datetime.datetime.now()
+      self._timestamp["mappings_changed"] = datetime.datetime.now()
+    else:
+      self._log_count_change(tagging.common.tag.ID_NONE)
+
+    self._untagged.discard(torrent_id)
+    self._active.discard(torrent_id)
 
 
   @check_init
@@ -718,6 +1029,12 @@ class Core(CorePluginBase):
           self._do_move_completed([torrent_id])
 
 
+  def on_torrent_state_changed(self, alert):
+
+    if self._initialized:
+      self._update_active_torrent(str(alert.handle.info_hash()))
+
+
   @check_init
   def get_torrent_tag_id(self, torrent_id):
 
@@ -736,6 +1053,12 @@ class Core(CorePluginBase):
     return self._filter_by_tag(torrent_ids, tag_ids)
 
 
+  @check_init
+  def filter_by_tag_tree(self, torrent_ids, tag_ids):
+
+    return self._filter_by_tag(torrent_ids, tag_ids, include_subtags=True)
+
+
   # Section: General
 
   def _get_daemon_info(self):
@@ -781,6 +1104,13 @@ class Core(CorePluginBase):
     if options["shared_limit_interval"] < 1:
       options["shared_limit_interval"] = 1
 
+    if options["autotag_regex_budget"] < 0:
+      options["autotag_regex_budget"] = 0
+
+    for key in ("shared_limit_threshold", "shared_limit_threshold_ratio"):
+      if options[key] < 0.0:
+        options[key] = 0.0
+
 
   # Section: Tag: Queries
 
@@ -812,7 +1142,7 @@ class Core(CorePluginBase):
 
     names = []
 
-    for id in self._index[parent_id]["children"]:
+    for id in self._index[parent_id].children:
       names.append(self._tags[id]["name"])
 
     return names
@@ -841,7 +1171,7 @@ class Core(CorePluginBase):
       if depth > 0:
         depth -= 1
 
-      for id in self._index[tag_id]["children"]:
+      for id in self._index[tag_id].children:
         descendents.append(id)
         descendents += self._get_descendent_tags(id, depth)
 
@@ -888,55 +1218,220 @@ class Core(CorePluginBase):
     if tag_id == tagging.common.tag.ID_NONE:
       torrent_ids = self._get_untagged_torrents()
     else:
-      torrent_ids = self._index[tag_id]["torrents"]
+      torrent_ids = self._index[tag_id].torrents
 
     return self._get_torrent_bandwidth_usage(torrent_ids)
 
 
-  def _get_sorted_tags(self, cmp_func=None, reverse=False):
+  def _get_tag_count(self, tag_id):
 
-    if self._timestamp["tags_sorted"] <= self._timestamp["tags_changed"]:
-      self._sorted_tags.clear()
+    if tag_id == tagging.common.tag.ID_ALL:
+      return len(self._torrents)
 
-    key = (cmp_func, reverse)
+    if tag_id == tagging.common.tag.ID_NONE:
+      return len(self._untagged)
 
-    if key not in self._sorted_tags:
-      self._sorted_tags[key] = sorted(self._tags,
-        cmp=key[0], reverse=key[1])
+    return len(self._index[tag_id].torrents)
 
-      self._timestamp["tags_sorted"] = datetime.datetime.now()
 
-    return self._sorted_tags[key]
+  def _get_tag_data(self, tag_id):
+
+    if tag_id in (tagging.common.tag.ID_ALL, tagging.common.tag.ID_NONE):
+      name = tag_id
+    else:
+      name = self._tags[tag_id]["name"]
+
+    data = {
+      "name": name,
+      "count": self._get_tag_count(tag_id),
+    }
+
+    return data
 
 
   def _get_tags_data(self):
 
-    total_count = len(self._torrents)
-    tagged_count = 0
     data = {}
 
-    tag_ids = self._get_sorted_tags(cmp_length_then_value)
+    for id in self._tags:
+      data[id] = self._get_tag_data(id)
 
-    for id in tag_ids:
-      count = len(self._index[id]["torrents"])
-      tagged_count += count
+    data[tagging.common.tag.ID_ALL] = self._get_tag_data(
+      tagging.common.tag.ID_ALL)
+    data[tagging.common.tag.ID_NONE] = self._get_tag_data(
+      tagging.common.tag.ID_NONE)
 
-      data[id] = {
-        "name": self._tags[id]["name"],
-        "count": count,
-      }
+    return data
 
-    data[tagging.common.tag.ID_ALL] = {
-      "name": tagging.common.tag.ID_ALL,
-      "count": total_count,
-    }
 
-    data[tagging.common.tag.ID_NONE] = {
-      "name": tagging.common.tag.ID_NONE,
-      "count": total_count-lagged_count,
+  # Section: Tag: Updates
+
+  def _log_change(self, tag_id, kind=CHANGE_TAG):
+
+    self._revision += 1
+
+    # Keep one entry per tag, remembering when its last tag change happened
+    # so that later count changes can still be sent as counts only
+    entry = self._changelog.pop(tag_id, None)
+
+    if kind == CHANGE_TAG:
+      tag_revision = self._revision
+    elif entry:
+      tag_revision = entry[1]
+    else:
+      tag_revision = 0
+
+    self._changelog[tag_id] = (self._revision, tag_revision)
+
+    while len(self._changelog) > CHANGELOG_SIZE:
+      id, entry = self._changelog.popitem(last=False)
+      self._changelog_floor = entry[0]
+
+    if not self._change_event_call or not self._change_event_call.active():
+      self._change_event_call = twisted.internet.reactor.callLater(
+        CHANGE_EVENT_DELAY, self._emit_change_event)
+
+
+  def _emit_change_event(self):
+
+    self._change_event_call = None
+
+    if self._initialized:
+      deluge.component.get("EventManager").emit(
+        TaggingChangedEvent(self._get_revision_token()))
+
+
+  def _log_count_change(self, tag_id):
+
+    self._log_change(tag_id, CHANGE_COUNT)
+
+
+  def _get_tags_delta(self, since):
+
+    assert(self._changelog_floor <= since <= self._revision)
+
+    delta = {
+      "tags": {},
+      "counts": {},
+      "removed": [],
     }
 
-    return data
+    for id in reversed(self._changelog):
+      revision, tag_revision = self._changelog[id]
+      if revision <= since:
+        break
+
+      if (id in self._tags or id == tagging.common.tag.ID_ALL or
+          id == tagging.common.tag.ID_NONE):
+        if tag_revision <= since:
+          delta["counts"][id] = self._get_tag_count(id)
+        else:
+          delta["tags"][id] = self._get_tag_data(id)
+      else:
+        delta["removed"].append(id)
+
+    return delta
+
+
+  def _get_revision_token(self):
+
+    return "%s%s:%s" % (REVISION_PREFIX, self._session_id, self._revision)
+
+
+  #
+  # Returns the revision in a token from this session, or None if the token
+  # is from another session or malformed.
+  #
+
+  def _parse_revision_token(self, token):
+
+    session_id, sep, revision = token[len(REVISION_PREFIX):].partition(":")
+    if not sep or session_id != self._session_id:
+      return None
+
+    try:
+      return int(revision)
+    except ValueError:
+      return None
+
+
+  def _get_update_key(self, since=None):
+
+    if isinstance(since, basestring):
+      if since.startswith(REVISION_PREFIX):
+        since = self._parse_revision_token(since)
+        if since is None:
+          return (TagUpdate.TYPE_FULL,)
+      else:
+        # Older clients send a pickled timestamp
+        since = cPickle.loads(since)
+    elif since is not None and not isinstance(since, datetime.datetime):
+      # Revisions without a session id can't be trusted
+      return (TagUpdate.TYPE_FULL,)
+
+    if isinstance(since, datetime.datetime):
+      last_changed = max(self._timestamp["tags_changed"],
+        self._timestamp["mappings_changed"])
+
+      if since > last_changed:
+        return None
+
+      since = None
+
+    if since == self._revision:
+      return None
+
+    if since is None or not (
+        self._changelog_floor <= since < self._revision):
+      return (TagUpdate.TYPE_FULL,)
+
+    return (TagUpdate.TYPE_DELTA, since)
+
+
+  def _build_tag_update(self, form, key):
+
+    if key[0] == TagUpdate.TYPE_DELTA:
+      data = self._get_tags_delta(key[1])
+    else:
+      data = self._get_tags_data()
+
+    u = TagUpdate(key[0], datetime.datetime.now(), data,
+      self._get_revision_token())
+
+    if form == UPDATE_FORM_DICT:
+      return {
+        "type": u.type,
+        "timestamp": cPickle.dumps(u.timestamp),
+        "revision": u.revision,
+        "data": u.data
+      }
+    else:
+      return cPickle.dumps(u)
+
+
+  #
+  # Serialized updates are cached per form and update key for the current
+  # revision, so each one is only built and pickled once between changes.
+  # The timestamp is the time the update was built; any change bumps the
+  # revision and drops the cache, so it never predates the data.
+  #
+
+  def _get_cached_update(self, form, key):
+
+    if self._update_cache_revision != self._revision:
+      self._update_cache.clear()
+      self._update_cache_revision = self._revision
+
+    stats = self._stats["update_cache"]
+    cache_key = (form,) + key
+
+    if cache_key in self._update_cache:
+      stats["hits"] += 1
+    else:
+      stats["misses"] += 1
+      self._update_cache[cache_key] = self._build_tag_update(form, key)
+
+    return self._update_cache[cache_key]
 
 
   # Section: Tag: Modifiers
@@ -956,18 +1451,15 @@ class Core(CorePluginBase):
     self._validate_name(parent_id, tag_name)
 
     id = self._get_unused_id(parent_id)
-    self._index[parent_id]["children"].append(id)
+    self._index[parent_id].add_child(id)
 
     self._tags[id] = {
       "name": tag_name,
       "options": copy.deepcopy(self._prefs["tag"]),
     }
 
-    self._index[id] = {
-      "fullname": self._resolve_fullname(id),
-      "children": [],
-      "torrents": [],
-    }
+    self._index[id] = TagIndex(self._resolve_fullname(id),
+      tagging.core.tag_index.get_depth(id))
 
     self._tags[id]["options"]["move_completed_path"] = \
       self._resolve_move_path(id)
@@ -975,6 +1467,9 @@ class Core(CorePluginBase):
     if self._tags[id]["options"]["shared_limit"]:
       self._shared_limit_index.append(id)
 
+    self._compile_autotag_rules(id)
+    self._log_change(id)
+
     return id
 
 
@@ -992,6 +1487,7 @@ class Core(CorePluginBase):
     parent_id = tagging.common.tag.get_parent_id(tag_id)
     self._validate_name(parent_id, tag_name)
     self._tags[tag_id]["name"] = tag_name
+    self._log_change(tag_id)
 
     self._build_fullname_index(tag_id)
     self._update_move_completed_paths(tag_id)
@@ -1005,33 +1501,38 @@ class Core(CorePluginBase):
     def reparent(tag_id, dest_id):
 
       id = self._get_unused_id(dest_id)
-      self._index[dest_id]["children"].append(id)
+      self._index[dest_id].add_child(id)
 
       self._tags[id] = self._tags[tag_id]
 
-      self._index[id] = {
-        "fullname": self._resolve_fullname(id),
-        "torrents": self._index[tag_id]["torrents"],
-        "children": [],
-      }
+      self._index[id] = TagIndex(self._resolve_fullname(id),
+        tagging.core.tag_index.get_depth(id))
+      self._index[id].torrents = self._index[tag_id].torrents
 
       if tag_id in self._shared_limit_index:
         self._shared_limit_index.remove(tag_id)
         self._shared_limit_index.append(id)
 
+      self._cancel_autotag_jobs(tag_id)
+      self._autotag.remove_tag(tag_id)
+      self._compile_autotag_rules(id)
+
       parent_id = tagging.common.tag.get_parent_id(tag_id)
       if parent_id in self._index:
-        self._index[parent_id]["children"].remove(tag_id)
+        self._index[parent_id].remove_child(tag_id)
 
-      for torrent_id in self._index[tag_id]["torrents"]:
+      for torrent_id in self._index[tag_id].torrents:
         self._mappings[torrent_id] = id
 
-      for child_id in list(self._index[tag_id]["children"]):
+      for child_id in list(self._index[tag_id].children):
         reparent(child_id, id)
 
       del self._index[tag_id]
       del self._tags[tag_id]
 
+      self._log_change(tag_id)
+      self._log_change(id)
+
       return id
 
 
@@ -1050,6 +1551,7 @@ class Core(CorePluginBase):
     id = reparent(tag_id, dest_id)
 
     self._tags[id]["name"] = dest_name
+    self._log_change(id)
     self._update_move_completed_paths(id)
 
     if self._prefs["options"]["move_on_changes"]:
@@ -1063,16 +1565,19 @@ class Core(CorePluginBase):
     if tag_id in self._shared_limit_index:
       self._shared_limit_index.remove(tag_id)
 
+    self._cancel_autotag_jobs(tag_id)
+    self._autotag.remove_tag(tag_id)
+
     parent_id = tagging.common.tag.get_parent_id(tag_id)
     if parent_id in self._index:
-      self._index[parent_id]["children"].remove(tag_id)
+      self._index[parent_id].remove_child(tag_id)
 
-    for id in list(self._index[tag_id]["children"]):
+    for id in list(self._index[tag_id].children):
       self._remove_tag(id)
 
     torrent_ids = []
 
-    for id in list(self._index[tag_id]["torrents"]):
+    for id in list(self._index[tag_id].torrents):
       if id in self._torrents:
         self._set_torrent_tag(id, tagging.common.tag.ID_NONE)
         torrent_ids.append(id)
@@ -1080,6 +1585,8 @@ class Core(CorePluginBase):
     del self._index[tag_id]
     del self._tags[tag_id]
 
+    self._log_change(tag_id)
+
     if (self._prefs["options"]["move_on_changes"] and
         self._core["move_completed"]):
       self._do_move_completed(torrent_ids)
@@ -1114,11 +1621,22 @@ class Core(CorePluginBase):
     options["max_connections"] = int(options["max_connections"])
     options["max_upload_slots"] = int(options["max_upload_slots"])
 
-    rules = options["autotag_rules"]
-    options["autotag_rules"] = list(options["autotag_rules"])
-    for rule in rules:
+    # Zero uses the global shared limit interval
+    if options["shared_limit_interval"] < 0:
+      options["shared_limit_interval"] = 0
+    elif 0 < options["shared_limit_interval"] < 1:
+      options["shared_limit_interval"] = 1
+
+    options["autotag_rules"] = self._normalize_autotag_rules(
+      options["autotag_rules"])
+
+
+  def _normalize_autotag_rules(self, rules_in):
+
+    rules = list(rules_in)
+    for rule in rules_in:
       if len(rule) != tagging.common.config.autotag.NUM_FIELDS:
-        options["autotag_rules"].remove(rule)
+        rules.remove(rule)
         continue
 
       prop, op, case, query = rule
@@ -1126,7 +1644,10 @@ class Core(CorePluginBase):
           op not in tagging.common.config.autotag.OPS or
           case not in tagging.common.config.autotag.CASES or
           not query):
-        options["autotag_rules"].remove(rule)
+        rules.remove(rule)
+        continue
+
+    return rules
 
 
   def _set_tag_options(self, tag_id, options_in, apply_to_all=None):
@@ -1144,13 +1665,15 @@ class Core(CorePluginBase):
     self._normalize_tag_options(options_in, self._prefs["tag"])
     options.update(options_in)
 
+    self._compile_autotag_rules(tag_id)
+
     if tag_id in self._shared_limit_index:
       self._shared_limit_index.remove(tag_id)
 
     if options["bandwidth_settings"] and options["shared_limit"]:
       self._shared_limit_index.append(tag_id)
 
-    for id in self._index[tag_id]["torrents"]:
+    for id in self._index[tag_id].torrents:
       self._apply_torrent_options(id)
 
     # If move completed was just turned on and move on changes enabled...
@@ -1161,7 +1684,7 @@ class Core(CorePluginBase):
 
     if options["move_completed_path"] != old["move_completed_path"]:
     # Path was modified; make sure descendent paths are updated
-      for id in self._index[tag_id]["children"]:
+      for id in self._index[tag_id].children:
         self._update_move_completed_paths(id)
 
         if self._prefs["options"]["move_on_changes"]:
@@ -1173,8 +1696,24 @@ class Core(CorePluginBase):
       self._timestamp["tags_changed"] = datetime.datetime.now()
 
     if options["autotag_settings"] and apply_to_all is not None:
+      if apply_to_all:
+        return self._start_autotag_job(tag_id)
+
       self._do_autotag_torrents(tag_id, apply_to_all)
 
+    return None
+
+
+  def _compile_autotag_rules(self, tag_id):
+
+    assert(tag_id in self._tags)
+
+    options = self._tags[tag_id]["options"]
+
+    # Invalid regexes compile to rules that never match
+    self._autotag.set_tag(tag_id, options["autotag_rules"],
+      options["autotag_match_all"], options["autotag_settings"])
+
 
   # Section: Tag: Full Name
 
@@ -1200,14 +1739,64 @@ class Core(CorePluginBase):
     assert(tag_id == tagging.common.tag.ID_NULL or
       tag_id in self._tags)
 
-    self._index[tag_id]["fullname"] = self._resolve_fullname(tag_id)
+    self._index[tag_id].fullname = self._resolve_fullname(tag_id)
 
-    for id in self._index[tag_id]["children"]:
+    for id in self._index[tag_id].children:
       self._build_fullname_index(id)
 
 
   # Section: Tag: Shared Limit
 
+  def _get_shared_limit_interval(self, tag_id):
+
+    interval = self._tags[tag_id]["options"]["shared_limit_interval"]
+    if interval > 0:
+      return interval
+
+    return self._prefs["options"]["shared_limit_interval"]
+
+
+  #
+  # Returns the shared limit tags due at the given time, most overdue first,
+  # at most SHARED_LIMIT_TAGS_PER_TICK of them. Newly seen tags are given
+  # phases spread evenly across their interval.
+  #
+
+  def _get_due_shared_limit_tags(self, now):
+
+    due = self._shared_limit_due
+    tag_ids = [x for x in self._shared_limit_index if x in self._tags]
+
+    for id in due.keys():
+      if id not in self._tags or id not in self._shared_limit_index:
+        del due[id]
+
+    new_ids = [x for x in tag_ids if x not in due]
+    for i, id in enumerate(new_ids):
+      due[id] = now + float(self._get_shared_limit_interval(id)) * i / \
+        len(new_ids)
+
+    due_ids = sorted((x for x in tag_ids if due[x] <= now), key=due.get)
+    if len(due_ids) > SHARED_LIMIT_TAGS_PER_TICK:
+      self._stats["shared_limit"]["deferred"] += \
+        len(due_ids) - SHARED_LIMIT_TAGS_PER_TICK
+      del due_ids[SHARED_LIMIT_TAGS_PER_TICK:]
+
+    return due_ids
+
+
+  def _reschedule_shared_limit(self, tag_id, now):
+
+    interval = self._get_shared_limit_interval(tag_id)
+    next_due = self._shared_limit_due[tag_id] + interval
+
+    # Keep the phase unless the tag fell a whole interval behind
+    if next_due <= now:
+      next_due = now + interval
+
+    self._shared_limit_due[tag_id] = next_due
+
+
   def _do_update_shared_limit(self, tag_id):
 
     assert(tag_id in self._tags)
@@ -1219,67 +1808,59 @@ class Core(CorePluginBase):
     if shared_download_limit < 0.0 and shared_upload_limit < 0.0:
       return
 
-    torrent_ids = self._index[tag_id]["torrents"]
+    torrent_ids = self._index[tag_id].torrents
 
-    statuses = self._get_torrent_statuses(
-      torrent_ids, {"state": ["Seeding", "Downloading"]},
-      ["download_payload_rate", "upload_payload_rate"])
+    statuses = self._get_rate_snapshot(torrent_ids)
+    ids = statuses.keys()
 
-    num_active_downloads = \
-      sum(1 for id in statuses if statuses[id]["download_payload_rate"] > 0.0)
-    download_rate_sum = \
-      sum(statuses[id]["download_payload_rate"] for id in statuses) / 1024.0
-    download_diff = download_rate_sum - shared_download_limit
-
-    num_active_uploads = \
-      sum(1 for id in statuses if statuses[id]["upload_payload_rate"] > 0.0)
-    upload_rate_sum = \
-      sum(statuses[id]["upload_payload_rate"] for id in statuses) / 1024.0
-    upload_diff = upload_rate_sum - shared_upload_limit
+    download_limits = allocate_shared_limit(
+      array.array("d", [statuses[x]["download_payload_rate"] for x in ids]),
+      shared_download_limit)
+    upload_limits = allocate_shared_limit(
+      array.array("d", [statuses[x]["upload_payload_rate"] for x in ids]),
+      shared_upload_limit)
 
     # Modify individual torrent bandwidth limits based on shared limit
-    for id in statuses:
-      torrent = self._torrents[id]
-      status = statuses[id]
+    for i, id in enumerate(ids):
+      limits = {
+        "max_download_speed": download_limits[i],
+        "max_upload_speed": upload_limits[i],
+      }
 
-      # Determine new torrent download limit
-      if shared_download_limit < 0.0:
-        torrent.set_max_download_speed(-1.0)
-      else:
-        download_rate = status["download_payload_rate"] / 1024.0
-        limit = download_rate
-
-        if download_diff >= 0.0:
-        # Total is above shared limit; deduct based on usage
-          usage_ratio = download_rate / download_rate_sum
-          limit -= (usage_ratio * download_diff)
-        elif download_rate > 0.0:
-        # Total is below and torrent active; increase by a slice of unused
-          limit += abs(download_diff) / num_active_downloads
-        else:
-        # Total is below and torrent inactive; give chance by setting max
-          limit = shared_download_limit
+      self._suppress_small_changes(id, limits)
+      self._update_torrent_options(id, limits)
 
-        if limit < 0.1: limit = 0.1
-        torrent.set_max_download_speed(limit)
 
-      # Determine new torrent upload limit
-      if shared_upload_limit < 0.0:
-        torrent.set_max_upload_speed(-1.0)
-      else:
-        upload_rate = status["upload_payload_rate"] / 1024.0
-        limit = upload_rate
-
-        if upload_diff >= 0.0:
-          usage_ratio = upload_rate / upload_rate_sum
-          limit -= (usage_ratio * upload_diff)
-        elif upload_rate > 0.0:
-          limit += abs(upload_diff) / num_active_uploads
-        else:
-          limit = shared_upload_limit
+  #
+  # Drops limits that differ from the applied ones by less than the absolute
+  # (KiB/s) or relative threshold. Changes to or from unlimited always apply.
+  #
+
+  def _suppress_small_changes(self, torrent_id, limits):
 
-        if limit < 0.1: limit = 0.1
-        torrent.set_max_upload_speed(limit)
+    threshold = self._prefs["options"]["shared_limit_threshold"]
+    ratio = self._prefs["options"]["shared_limit_threshold_ratio"]
+    stats = self._stats["shared_limit"]
+
+    current = self._torrents[torrent_id].options
+
+    for key in limits.keys():
+      old = current.get(key)
+      new = limits[key]
+
+      if old == new:
+        continue
+
+      if old is None or old < 0.0 or new < 0.0:
+        stats["issued"] += 1
+        continue
+
+      diff = abs(new - old)
+      if diff < threshold or diff < old * ratio:
+        del limits[key]
+        stats["suppressed"] += 1
+      else:
+        stats["issued"] += 1
 
 
   # Section: Torrent: Queries
@@ -1313,6 +1894,75 @@ class Core(CorePluginBase):
     return statuses
 
 
+  def _get_active_torrents(self, torrent_ids):
+
+    if len(torrent_ids) < len(self._active):
+      return torrent_ids & self._active
+
+    return self._active & torrent_ids
+
+
+  def _is_active_lt_status(self, status):
+
+    if status.paused or status.error:
+      return False
+
+    return int(status.state) in self._active_lt_states
+
+
+  def _update_active_torrent(self, torrent_id):
+
+    if torrent_id not in self._torrents:
+      self._active.discard(torrent_id)
+      return
+
+    torrent = self._torrents[torrent_id]
+
+    try:
+      active = self._is_active_lt_status(torrent.handle.status())
+    except AttributeError:
+      active = torrent.get_status(["state"])["state"] in (
+        "Seeding", "Downloading")
+
+    if active:
+      self._active.add(torrent_id)
+    else:
+      self._active.discard(torrent_id)
+
+
+  #
+  # Returns the payload rates of the given torrents that are Downloading or
+  # Seeding. Only the active ones are queried, each with a minimal status
+  # from libtorrent, so the cost follows the tag rather than the session.
+  #
+
+  def _get_rate_snapshot(self, torrent_ids):
+
+    torrent_ids = self._get_active_torrents(torrent_ids)
+    if not torrent_ids:
+      return {}
+
+    snapshot = {}
+
+    try:
+      if deluge.component.get("Core").session.is_paused():
+        return {}
+
+      for id in torrent_ids:
+        status = self._torrents[id].handle.status(0)
+        if self._is_active_lt_status(status):
+          snapshot[id] = {
+            "download_payload_rate": status.download_payload_rate,
+            "upload_payload_rate": status.upload_payload_rate,
+          }
+    except (AttributeError, TypeError):
+      return self._get_torrent_statuses(torrent_ids,
+        {"state": ["Seeding", "Downloading"]},
+        ["download_payload_rate", "upload_payload_rate"])
+
+    return snapshot
+
+
   def _get_torrent_bandwidth_usage(self, torrent_ids):
 
     assert(all(x in self._torrents for x in torrent_ids))
@@ -1334,30 +1984,55 @@ class Core(CorePluginBase):
 
   # Section: Torrent: Modifiers
 
-  def _reset_torrent_options(self, torrent_id):
+  #
+  # Deluge's setters keep torrent.options current, so options that already
+  # have the requested value are skipped, whoever set them.
+  #
+
+  def _update_torrent_options(self, torrent_id, options):
 
     assert(torrent_id in self._torrents)
 
     torrent = self._torrents[torrent_id]
+    stats = self._stats["torrent_options"]
 
-    # Download settings
-    torrent.set_move_completed(self._core["move_completed"])
-    torrent.set_move_completed_path(self._core["move_completed_path"])
-    torrent.set_prioritize_first_last(
-      self._core["prioritize_first_last_pieces"])
+    for key in TORRENT_OPTION_KEYS:
+      if key not in options:
+        continue
+
+      if options[key] == torrent.options.get(key):
+        stats["skipped"] += 1
+        continue
 
-    # Bandwidth settings
-    torrent.set_max_download_speed(
-      self._core["max_download_speed_per_torrent"])
-    torrent.set_max_upload_speed(self._core["max_upload_speed_per_torrent"])
-    torrent.set_max_connections(self._core["max_connections_per_torrent"])
-    torrent.set_max_upload_slots(self._core["max_upload_slots_per_torrent"])
+      getattr(torrent, TORRENT_OPTION_SETTERS[key])(options[key])
+      stats["issued"] += 1
 
-    # Queue settings
-    torrent.set_auto_managed(self._core["auto_managed"])
-    torrent.set_stop_at_ratio(self._core["stop_seed_at_ratio"])
-    torrent.set_stop_ratio(self._core["stop_seed_ratio"])
-    torrent.set_remove_at_ratio(self._core["remove_seed_at_ratio"])
+
+  def _reset_torrent_options(self, torrent_id):
+
+    assert(torrent_id in self._torrents)
+
+    options = {
+      # Download settings
+      "move_completed": self._core["move_completed"],
+      "move_completed_path": self._core["move_completed_path"],
+      "prioritize_first_last_pieces":
+        self._core["prioritize_first_last_pieces"],
+
+      # Bandwidth settings
+      "max_download_speed": self._core["max_download_speed_per_torrent"],
+      "max_upload_speed": self._core["max_upload_speed_per_torrent"],
+      "max_connections": self._core["max_connections_per_torrent"],
+      "max_upload_slots": self._core["max_upload_slots_per_torrent"],
+
+      # Queue settings
+      "auto_managed": self._core["auto_managed"],
+      "stop_at_ratio": self._core["stop_seed_at_ratio"],
+      "stop_ratio": self._core["stop_seed_ratio"],
+      "remove_at_ratio": self._core["remove_seed_at_ratio"],
+    }
+
+    self._update_torrent_options(torrent_id, options)
 
 
   def _apply_torrent_options(self, torrent_id):
@@ -1371,41 +2046,39 @@ class Core(CorePluginBase):
       return
 
     options = self._tags[tag_id]["options"]
-    torrent = self._torrents[torrent_id]
+    torrent_options = {}
 
     if options["download_settings"]:
-      torrent.set_move_completed(options["move_completed"])
-      torrent.set_prioritize_first_last(options["prioritize_first_last"])
+      torrent_options["move_completed"] = options["move_completed"]
+      torrent_options["prioritize_first_last_pieces"] = \
+        options["prioritize_first_last"]
 
       if options["move_completed"]:
-        torrent.set_move_completed_path(options["move_completed_path"])
+        torrent_options["move_completed_path"] = \
+          options["move_completed_path"]
 
     if options["bandwidth_settings"]:
-      torrent.set_max_download_speed(options["max_download_speed"])
-      torrent.set_max_upload_speed(options["max_upload_speed"])
-      torrent.set_max_connections(options["max_connections"])
-      torrent.set_max_upload_slots(options["max_upload_slots"])
+      torrent_options["max_download_speed"] = options["max_download_speed"]
+      torrent_options["max_upload_speed"] = options["max_upload_speed"]
+      torrent_options["max_connections"] = options["max_connections"]
+      torrent_options["max_upload_slots"] = options["max_upload_slots"]
 
     if options["queue_settings"]:
-      torrent.set_auto_managed(options["auto_managed"])
-      torrent.set_stop_at_ratio(options["stop_at_ratio"])
+      torrent_options["auto_managed"] = options["auto_managed"]
+      torrent_options["stop_at_ratio"] = options["stop_at_ratio"]
 
       if options["stop_at_ratio"]:
-        torrent.set_stop_ratio(options["stop_ratio"])
-        torrent.set_remove_at_ratio(options["remove_at_ratio"])
+        torrent_options["stop_ratio"] = options["stop_ratio"]
+        torrent_options["remove_at_ratio"] = options["remove_at_ratio"]
+
+    self._update_torrent_options(torrent_id, torrent_options)
 
 
   # Section: Torrent-Tag: Queries
 
   def _get_untagged_torrents(self):
 
-    torrent_ids = []
-
-    for id in self._torrents:
-      if id not in self._mappings:
-        torrent_ids.append(id)
-
-    return torrent_ids
+    return self._untagged
 
 
   def _get_torrent_tag_id(self, torrent_id):
@@ -1419,10 +2092,30 @@ class Core(CorePluginBase):
     if tag_id == tagging.common.tag.ID_NONE:
       return ""
 
-    return self._index[tag_id]["fullname"]
+    return self._index[tag_id].fullname
+
+
+  def _filter_by_tag(self, torrent_ids, tag_ids, include_subtags=False):
+
+    tag_ids = set(tag_ids)
+
+    if include_subtags:
+      for id in list(tag_ids):
+        if id in self._tags:
+          tag_ids.update(self._get_descendent_tags(id))
+
+    # Candidates are all torrents; take the members straight from the index
+    if (len(torrent_ids) == len(self._torrents) and
+        self._torrents.viewkeys() == set(torrent_ids)):
+      filtered = set()
 
+      for id in tag_ids:
+        if id == tagging.common.tag.ID_NONE:
+          filtered.update(self._untagged)
+        elif id in self._tags:
+          filtered.update(self._index[id].torrents)
 
-  def _filter_by_tag(self, torrent_ids, tag_ids):
+      return list(filtered)
 
     filtered = []
 
@@ -1440,10 +2133,14 @@ class Core(CorePluginBase):
 
     tag_id = self._mappings.get(torrent_id, tagging.common.tag.ID_NONE)
     if tag_id in self._index:
-      self._index[tag_id]["torrents"].remove(torrent_id)
+      self._index[tag_id].remove_torrent(torrent_id)
+      self._log_count_change(tag_id)
 
     del self._mappings[torrent_id]
 
+    if torrent_id in self._torrents:
+      self._untagged.add(torrent_id)
+
 
   def _set_torrent_tag(self, torrent_id, tag_id):
 
@@ -1451,6 +2148,11 @@ class Core(CorePluginBase):
     assert(tag_id == tagging.common.tag.ID_NONE or
       tag_id in self._tags)
 
+    old_id = self._mappings.get(torrent_id, tagging.common.tag.ID_NONE)
+    if old_id == tag_id:
+      self._apply_torrent_options(torrent_id)
+      return False
+
     if torrent_id in self._mappings:
       self._remove_torrent_tag(torrent_id)
 
@@ -1458,46 +2160,120 @@ class Core(CorePluginBase):
       self._reset_torrent_options(torrent_id)
     else:
       self._mappings[torrent_id] = tag_id
-      self._index[tag_id]["torrents"].append(torrent_id)
+      self._index[tag_id].add_torrent(torrent_id)
+      self._untagged.discard(torrent_id)
+      self._log_count_change(tag_id)
       self._apply_torrent_options(torrent_id)
 
+    if (old_id == tagging.common.tag.ID_NONE or
+        tag_id == tagging.common.tag.ID_NONE):
+      self._log_count_change(tagging.common.tag.ID_NONE)
+
+    return True
+
 
   # Section: Torrent-Tag: Autotag
 
-  def _has_autotag_match(self, torrent_id, tag_id):
+  def _get_autotag_props(self, torrent_id):
 
     assert(torrent_id in self._torrents)
-    assert(tag_id in self._tags)
-
-    options = self._tags[tag_id]["options"]
-    rules = options["autotag_rules"]
-    match_all = options["autotag_match_all"]
 
     status = self._torrents[torrent_id].get_status(["name", "trackers"])
     name = status["name"]
     trackers = [x["url"] for x in status["trackers"]]
 
-    props = {
-      tagging.common.config.autotag.PROP_NAME: [name],
-      tagging.common.config.autotag.PROP_TRACKER: trackers,
-    }
-
-    return tagging.common.config.autotag.find_match(props,
-      rules, match_all)
+    return self._autotag.get_props(torrent_id, name, trackers)
 
 
   def _find_autotag_match(self, torrent_id):
 
     assert(torrent_id in self._torrents)
 
-    tag_ids = self._get_sorted_tags(cmp_length_then_value)
+    props = self._get_autotag_props(torrent_id)
+
+    return self._autotag.find_match(props) or tagging.common.tag.ID_NONE
+
+
+  #
+  # Only torrents whose tag could change are evaluated: untagged torrents,
+  # or every torrent if apply_to_all is set. Results are kept by the autotag
+  # engine, so a diff followed by a run evaluates each torrent once.
+  #
+  # Returns (gained, lost), where lost are current members of the tag that
+  # no longer match, which is only known if apply_to_all is set.
+  #
 
-    for id in tag_ids:
-      if self._tags[id]["options"]["autotag_settings"]:
-        if self._has_autotag_match(torrent_id, id):
-          return id
+  def _get_autotag_diff(self, tag_id, apply_to_all=False):
 
-    return tagging.common.tag.ID_NONE
+    assert(tag_id in self._tags)
+
+    gained = []
+    lost = []
+
+    for result in self._iter_autotag_diff(tag_id, apply_to_all, gained, lost):
+      pass
+
+    return gained, lost
+
+
+  #
+  # Evaluates the torrents of an autotag diff one per iteration, adding them
+  # to gained or lost. Stops if the tag is removed or moved; its options
+  # object is used to detect a new tag that reused the id.
+  #
+
+  def _iter_autotag_diff(self, tag_id, apply_to_all, gained, lost):
+
+    if apply_to_all:
+      torrent_ids = list(self._torrents)
+    else:
+      torrent_ids = list(self._untagged)
+
+    tag = self._tags[tag_id]
+    members = self._index[tag_id].torrents
+
+    for id in torrent_ids:
+      if self._tags.get(tag_id) is not tag:
+        return
+
+      if id in self._torrents:
+        props = self._get_autotag_props(id)
+        has_match = self._autotag.has_torrent_match(id, props, tag_id)
+
+        if id in members:
+          if not has_match:
+            lost.append(id)
+        elif has_match:
+          gained.append(id)
+
+      yield None
+
+
+  def _start_autotag_diff(self, tag_id, apply_to_all=False):
+
+    def on_done(result, tag):
+
+      if self._tags.get(tag_id) is not tag:
+        raise TaggingError(ERR_INVALID_TAG)
+
+      diff = {
+        "gained": gained,
+        "lost": lost,
+      }
+
+      return diff
+
+
+    gained = []
+    lost = []
+
+    task = twisted.internet.task.cooperate(
+      self._iter_autotag_diff(tag_id, apply_to_all, gained, lost))
+
+    deferred = task.whenDone()
+    deferred.addCallback(on_done, self._tags[tag_id])
+
+    return deferred
 
 
   def _do_autotag_torrents(self, tag_id, apply_to_all=False):
@@ -1505,26 +2281,230 @@ class Core(CorePluginBase):
     assert(tag_id in self._tags)
 
     changed = False
+    gained, lost = self._get_autotag_diff(tag_id, apply_to_all)
 
-    for id in self._torrents:
-      if apply_to_all or id not in self._mappings:
-        if self._has_autotag_match(id, tag_id):
-          self._set_torrent_tag(id, tag_id)
-          changed = True
+    for id in gained:
+      if self._set_torrent_tag(id, tag_id):
+        changed = True
 
     if changed:
       self._timestamp["mappings_changed"] = datetime.datetime.now()
 
 
+  #
+  # Evaluates rules against every torrent without changing mappings or the
+  # autotag engine's statistics. Every rule is evaluated to collect its hit
+  # count, but whether a torrent matches is decided the same way as
+  # find_match. A regex rule over the regex budget stops the run early with
+  # the rule marked disabled. Returns a deferred that fires with the results.
+  #
+
+  def _test_autotag_rules(self, rules_in, match_all=False):
+
+    def evaluate(torrent_ids):
+
+      budget = self._prefs["options"]["autotag_regex_budget"]/1000.0
+
+      for id in torrent_ids:
+        if id in self._torrents:
+          props = self._get_autotag_props(id)
+          hits = []
+
+          for i, rule in enumerate(rules):
+            if results["rules"][i]["disabled"]:
+              hits.append(False)
+              continue
+
+            start = time.time()
+            hits.append(tagging.common.config.autotag.find_match(props,
+              [rule]))
+            elapsed = time.time() - start
+
+            if (rule.op == tagging.common.config.autotag.OP_MATCHES_REGEX and
+                budget and elapsed > budget):
+              results["rules"][i]["disabled"] = True
+              results["complete"] = False
+              return
+
+          for i, hit in enumerate(hits):
+            if hit:
+              results["rules"][i]["hits"] += 1
+
+          if rules and (all(hits) if match_all else any(hits)):
+            results["matched"] += 1
+            if len(results["sample"]) < AUTOTAG_SAMPLE_SIZE:
+              results["sample"].append(id)
+
+          results["total"] += 1
+
+        yield None
+
+
+    def on_done(result, start):
+
+      results["elapsed"] = time.time() - start
+
+      for rule in results["rules"]:
+        rule["rate"] = (float(rule["hits"]) / results["total"] if
+          results["total"] else 0.0)
+
+      return results
+
+
+    rules_in = self._normalize_autotag_rules(rules_in)
+    rules = tagging.common.config.autotag.compile_rules(rules_in,
+      strict=False)
+
+    results = {
+      "total": 0,
+      "matched": 0,
+      "sample": [],
+      "rules": [{
+        "rule": x,
+        "hits": 0,
+        "disabled": (x[1] == tagging.common.config.autotag.OP_MATCHES_REGEX and
+          tagging.common.config.autotag.is_unsafe_regex(x[3])),
+      } for x in rules_in],
+      "complete": True,
+      "elapsed": 0.0,
+    }
+
+    task = twisted.internet.task.cooperate(evaluate(list(self._torrents)))
+
+    deferred = task.whenDone()
+    deferred.addCallback(on_done, time.time())
+
+    return deferred
+
+
+  def _update_regex_budget(self):
+
+    budget = self._prefs["options"]["autotag_regex_budget"]
+    self._autotag.set_regex_budget(budget/1000.0 if budget else None)
+
+
+  # Section: Torrent-Tag: Autotag Jobs
+
+  def _start_autotag_job(self, tag_id):
+
+    def evaluate(job):
+
+      for id in job.torrent_ids:
+        if id in self._torrents:
+          props = self._get_autotag_props(id)
+          if self._autotag.has_torrent_match(id, props, tag_id):
+            job.matched.append(id)
+
+        job.evaluated += 1
+        yield None
+
+
+    # The job is cancelled when its tag is removed or moved, so its state is
+    # checked rather than the tag id, which may be reused by a new tag
+    def run(job):
+
+      if not job.is_active():
+        return
+
+      for result in evaluate(job):
+        yield result
+
+        if not job.is_active():
+          return
+
+      job.state = tagging.core.autotag.JOB_APPLYING
+      changed = False
+
+      for id in job.matched:
+        if not job.is_active():
+          break
+
+        if id in self._torrents and self._set_torrent_tag(id, tag_id):
+          changed = True
+
+        job.applied += 1
+        yield None
+
+      if changed:
+        self._timestamp["mappings_changed"] = datetime.datetime.now()
+
+
+    def on_done(result, job):
+
+      if not job.is_active():
+        return
+
+      job.finish(tagging.core.autotag.JOB_DONE)
+
+      log.debug("Autotag job %s for %r matched %s of %s torrents in %.3fs",
+        job.id, tag_id, len(job.matched), job.total,
+        job.finished-job.started)
+
+
+    def on_error(failure, job):
+
+      if failure.check(twisted.internet.task.TaskStopped):
+        return
+
+      log.error("Autotag job %s for %r failed: %s", job.id, tag_id,
+        failure.getErrorMessage())
+      job.finish(tagging.core.autotag.JOB_FAILED, failure.getErrorMessage())
+
+
+    # A newer job for the same tag supersedes any that is still running
+    self._cancel_autotag_jobs(tag_id)
+
+    job = AutotagJob(self._next_job_id, tag_id, list(self._torrents))
+    self._next_job_id += 1
+
+    self._autotag_jobs[job.id] = job
+    self._prune_autotag_jobs()
+
+    job.task = twisted.internet.task.cooperate(run(job))
+
+    deferred = job.task.whenDone()
+    deferred.addCallback(on_done, job)
+    deferred.addErrback(on_error, job)
+
+    return job.id
+
+
+  def _cancel_autotag_job(self, job):
+
+    if job.is_active():
+      task = job.task
+      job.finish(tagging.core.autotag.JOB_CANCELLED)
+
+      if task:
+        task.stop()
+
+
+  def _cancel_autotag_jobs(self, tag_id):
+
+    for job in self._autotag_jobs.values():
+      if job.tag_id == tag_id:
+        self._cancel_autotag_job(job)
+
+
+  def _prune_autotag_jobs(self):
+
+    finished = [x for x in self._autotag_jobs if
+      not self._autotag_jobs[x].is_active()]
+
+    for id in finished[:-AUTOTAG_JOB_HISTORY or None]:
+      del self._autotag_jobs[id]
+
+
   # Section: Torrent-Tag: Move Completed
 
   def _apply_move_completed_path(self, tag_id):
 
     assert(tag_id in self._tags)
 
-    for id in self._index[tag_id]["torrents"]:
-      self._torrents[id].set_move_completed_path(
-          self._tags[tag_id]["options"]["move_completed_path"])
+    path = self._tags[tag_id]["options"]["move_completed_path"]
+
+    for id in self._index[tag_id].torrents:
+      self._update_torrent_options(id, {"move_completed_path": path})
 
 
   def _update_move_completed_paths(self, tag_id):
@@ -1542,7 +2522,7 @@ class Core(CorePluginBase):
     if options["download_settings"] and options["move_completed"]:
       self._apply_move_completed_path(tag_id)
 
-    for id in self._index[tag_id]["children"]:
+    for id in self._index[tag_id].children:
       self._update_move_completed_paths(id)
 
 
@@ -1572,8 +2552,8 @@ class Core(CorePluginBase):
     options = self._tags[tag_id]["options"]
 
     if options["download_settings"] and options["move_completed"]:
-      self._do_move_completed(self._index[tag_id]["torrents"])
+      self._do_move_completed(self._index[tag_id].torrents)
 
     if subtags:
-      for id in self._index[tag_id]["children"]:
+      for id in self._index[tag_id].children:
         self._do_move_completed_by_tag(id, subtags)
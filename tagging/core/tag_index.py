@@ -0,0 +1,85 @@
+#
+# tag_index.py
+#
+# Copyright (C) 2014 Ratanak Lun <ratanakvlun@gmail.com>
+#
+# This module is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Linking this software with other modules is making a combined work
+# based on this software. Thus, the terms and conditions of the GNU
+# General Public License cover the whole combination.
+#
+# As a special exception, the copyright holders of this software give
+# you permission to link this software with independent modules to
+# produce a combined work, regardless of the license terms of these
+# independent modules, and to copy and distribute the resulting work
+# under terms of your choice, provided that you also meet, for each
+# linked module in the combined work, the terms and conditions of the
+# license of that module. An independent module is a module which is
+# not derived from or based on this software. If you modify this
+# software, you may extend this exception to your version of the
+# software, but you are not obligated to do so. If you do not wish to
+# do so, delete this exception statement from your version.
+#
+
+
+class TagIndex(object):
+
+  __slots__ = ("fullname", "depth", "children", "torrents")
+
+
+  def __init__(self, fullname="", depth=0, torrents=None):
+
+    self.fullname = fullname
+    self.depth = depth
+    self.children = set()
+    self.torrents = set(torrents) if torrents else set()
+
+
+  def __repr__(self):
+
+    return "<%s %r: children=%s, torrents=%s>" % (self.__class__.__name__,
+      self.fullname, len(self.children), len(self.torrents))
+
+
+  # Section: Children
+
+  def add_child(self, tag_id):
+
+    self.children.add(tag_id)
+
+
+  def remove_child(self, tag_id):
+
+    self.children.discard(tag_id)
+
+
+  # Section: Torrents
+
+  def add_torrent(self, torrent_id):
+
+    self.torrents.add(torrent_id)
+
+
+  def remove_torrent(self, torrent_id):
+
+    self.torrents.discard(torrent_id)
+
+
+def get_depth(tag_id):
+
+  if not tag_id:
+    return 0
+
+  return tag_id.count(":") + 1
@@ -63,6 +63,9 @@ Deluge.plugins.tagging.DISPLAY_NAME = _('Tagging');
 Deluge.plugins.tagging.STATUS_NAME =
   Deluge.plugins.tagging.MODULE_NAME + '_name';
 
+// Updates are requested on TaggingChangedEvent; polling is only a safety net
+Deluge.plugins.tagging.UPDATE_INTERVAL = 30000;
+
 
 Deluge.plugins.tagging.util.isReserved = function(id) {
   return (id == 'All' || id == 'None' || id == '');
@@ -91,6 +94,13 @@ Deluge.plugins.tagging.Plugin = Ext.extend(Deluge.Plugin, {
   },
 
   onDisable: function() {
+    deluge.events.un('TaggingChangedEvent', this._onTaggingChanged, this);
+
+    if (this._updateTimer) {
+      clearTimeout(this._updateTimer);
+      delete this._updateTimer;
+    }
+
     if (this._rootMenu) {
       this._rootMenu.destroy();
       delete this._rootMenu;
@@ -146,6 +156,8 @@ Deluge.plugins.tagging.Plugin = Ext.extend(Deluge.Plugin, {
   _finishInit: function(result) {
     if (result) {
       this._doUpdate(result);
+
+      deluge.events.on('TaggingChangedEvent', this._onTaggingChanged, this);
       this._updateLoop();
 
       console.log('%s enabled', Deluge.plugins.tagging.PLUGIN_NAME);
@@ -158,6 +170,19 @@ Deluge.plugins.tagging.Plugin = Ext.extend(Deluge.Plugin, {
     }
 
     this._lastUpdated = result.timestamp;
+    this._revision = result.revision;
+
+    if (result.type == 'Delta') {
+      this._applyDelta(result.data);
+
+      // The menu doesn't show counts; only rebuild it for tag changes
+      if (Object.keys(result.data.tags).length == 0 &&
+          result.data.removed.length == 0) {
+        return;
+      }
+    } else {
+      this._data = result.data;
+    }
 
     if (this._rootMenu) {
       this._rootMenu.destroy();
@@ -167,7 +192,7 @@ Deluge.plugins.tagging.Plugin = Ext.extend(Deluge.Plugin, {
     var menu = new Ext.menu.Menu({ ignoreParentClicks: true });
     menu.add({
       text: _('Set Tag'),
-      menu: this._createMenuFromData(result.data)
+      menu: this._createMenuFromData(this._data)
     });
 
     this._rootMenu = deluge.menus.torrent.add({
@@ -176,12 +201,59 @@ Deluge.plugins.tagging.Plugin = Ext.extend(Deluge.Plugin, {
     });
   },
 
+  _applyDelta: function(delta) {
+    var id;
+
+    for (var i = 0; i < delta.removed.length; i++) {
+      delete this._data[delta.removed[i]];
+    }
+
+    for (id in delta.tags) {
+      this._data[id] = delta.tags[id];
+    }
+
+    for (id in delta.counts) {
+      if (id in this._data) {
+        this._data[id].count = delta.counts[id];
+      }
+    }
+  },
+
+  _onTaggingChanged: function(revision) {
+    if (revision != this._revision) {
+      this._requestUpdate();
+    }
+  },
+
   _updateLoop: function() {
-    deluge.client.tagging.get_tag_updates_dict(this._lastUpdated, {
+    this._requestUpdate();
+
+    var self = this;
+    this._updateTimer = setTimeout(function() {
+      self._updateLoop.apply(self);
+    }, Deluge.plugins.tagging.UPDATE_INTERVAL);
+  },
+
+  _requestUpdate: function() {
+    if (this._updating) {
+      this._updateRequested = true;
+      return;
+    }
+
+    this._updating = true;
+    this._updateRequested = false;
+
+    deluge.client.tagging.get_tag_updates_dict(this._revision, {
       success: function(result) {
+        this._updating = false;
         this._doUpdate(result);
-        var self = this;
-        setTimeout(function() { self._updateLoop.apply(self); }, 1000);
+
+        if (this._updateRequested) {
+          this._requestUpdate();
+        }
+      },
+      failure: function() {
+        this._updating = false;
       },
       scope: this
     });
@@ -124,6 +124,54 @@ class TagStore(object):
     self._build_descendent_data()
 
 
+  def apply_delta(self, delta):
+
+    if not delta["tags"] and not delta["removed"]:
+      self.update_counts(delta["counts"])
+      return
+
+    data = {}
+
+    for id_ in self._data:
+      data[id_] = {
+        "name": self._data[id_]["name"],
+        "count": self._data[id_]["count"],
+      }
+
+    for id_ in delta["removed"]:
+      data.pop(id_, None)
+
+    for id_ in delta["tags"]:
+      data[id_] = dict(delta["tags"][id_])
+
+    for id_ in delta["counts"]:
+      if id_ in data:
+        data[id_]["count"] = delta["counts"][id_]
+
+    self.update(data)
+
+
+  def update_counts(self, counts):
+
+    ancestors = set()
+
+    for id_ in counts:
+      if id_ in self._data:
+        self._data[id_]["count"] = counts[id_]
+
+        if id_ not in RESERVED_IDS:
+          parent_id = tagging.common.tag.get_parent_id(id_)
+          while parent_id:
+            ancestors.add(parent_id)
+            parent_id = tagging.common.tag.get_parent_id(parent_id)
+
+    # Counts don't change the tree, so only refresh descendent totals
+    for id_ in ancestors:
+      if id_ in self._data:
+        descendents = self._data[id_]["descendents"]
+        descendents["count"] = self.get_total_count(descendents["ids"])
+
+
   def get_model_iter(self, id_):
 
     if id_ in self._map and self.model:
@@ -584,6 +584,9 @@ class TagOptionsDialog(WidgetEncapsulator):
 
     options = copy.deepcopy(self._tag_defaults)
 
+    # Keep current values of options that have no widget
+    options.update(copy.deepcopy(self._tag_options))
+
     for group in self._option_groups:
       self._get_widget_values(group, options)
 
@@ -514,6 +514,10 @@ class PreferencesExt(WidgetEncapsulator):
 
     prefs = copy.deepcopy(tagging.common.config.CONFIG_DEFAULTS["prefs"])
 
+    # Keep daemon values of options that have no widget
+    for key in prefs:
+      prefs[key].update(copy.deepcopy(self._prefs.get(key, {})))
+
     self._get_widget_values(self._daemon_option_group, prefs["options"])
 
     for group in self._option_groups:
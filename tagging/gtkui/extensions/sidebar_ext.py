@@ -118,6 +118,7 @@ class SidebarExt(object):
       self._create_menu()
 
       self._plugin.register_update_func(self.update_store)
+      self._plugin.register_count_func(self.update_counts)
     except:
       self.unload()
       raise
@@ -134,6 +135,7 @@ class SidebarExt(object):
   def unload(self):
 
     self._plugin.deregister_update_func(self.update_store)
+    self._plugin.deregister_count_func(self.update_counts)
 
     self._disable_dnd()
 
@@ -234,6 +236,12 @@ class SidebarExt(object):
     selection.handler_unblock_by_func(self._on_selection_changed)
 
 
+  # Rows share their data with the plugin store, so a redraw shows new counts
+  def update_counts(self, store):
+
+    self._tree.queue_draw()
+
+
   # Section: General
 
   def _register_handler(self, obj, signal, func, *args, **kwargs):
@@ -61,7 +61,7 @@ from tagging.gtkui.common.gtklib.dnd import DragTarget
 from tagging.common import (
   DISPLAY_NAME,
 
-  STATUS_NAME, STATUS_ID,
+  STATUS_NAME, STATUS_ID, FILTER_TREE_ID,
 )
 
 from tagging.common.tag import (
@@ -225,7 +225,9 @@ class TorrentViewExt(object):
 
   def _reset_filter(self):
 
-    if self._view.filter and self._view.filter.get(STATUS_ID) is not None:
+    if self._view.filter and (
+        self._view.filter.get(STATUS_ID) is not None or
+        self._view.filter.get(FILTER_TREE_ID) is not None):
       self._view.set_filter({})
 
 
@@ -250,7 +252,8 @@ class TorrentViewExt(object):
       filter = {}
     else:
       if self._plugin.config["common"]["filter_include_subtags"]:
-        filter = {STATUS_ID: self._get_full_family(ids)}
+        # Descendents are expanded by the core
+        filter = {FILTER_TREE_ID: tagging.common.tag.get_base_ancestors(ids)}
       else:
         filter = {STATUS_ID: ids}
 
@@ -267,7 +270,16 @@ class TorrentViewExt(object):
       tag_ids = self._view.filter[STATUS_ID]
 
       if self._plugin.config["common"]["filter_include_subtags"]:
-        tag_ids = tagging.common.tag.get_base_ancestors(tag_ids)
+        return False
+
+      if set(ids) == set(tag_ids):
+        return True
+
+    if FILTER_TREE_ID in self._view.filter:
+      tag_ids = self._view.filter[FILTER_TREE_ID]
+
+      if not self._plugin.config["common"]["filter_include_subtags"]:
+        return False
 
       if set(ids) == set(tag_ids):
         return True
@@ -345,16 +357,6 @@ class TorrentViewExt(object):
       self.set_filter(ids)
 
 
-  def _get_full_family(self, ids):
-
-    tag_ids = tagging.common.tag.get_base_ancestors(ids)
-
-    for id in list(tag_ids):
-      tag_ids += self._store[id]["descendents"]["ids"]
-
-    return tag_ids
-
-
   # Section: Context Menu
 
   def _create_context_menu(self):
@@ -58,6 +58,7 @@ from deluge.ui.client import client
 from deluge.ui.client import DelugeRPCError
 from deluge.plugins.pluginbase import GtkPluginBase
 
+from tagging.common import TagUpdate
 from tagging.common import TaggingError
 from tagging.gtkui.common.tag_store import TagStore
 from tagging.gtkui.extensions.add_torrent_ext import AddTorrentExt
@@ -76,7 +77,8 @@ from tagging.common.literals import (
 GTKUI_CONFIG = "%s_ui.conf" % tagging.common.MODULE_NAME
 
 INIT_POLLING_INTERVAL = 3.0
-UPDATE_INTERVAL = 1.0
+# Updates are requested on TaggingChangedEvent; polling is only a safety net
+UPDATE_INTERVAL = 30.0
 
 THROTTLED_INTERVAL = 6.0
 MAX_TRIES = 10
@@ -113,12 +115,16 @@ class GtkUI(GtkPluginBase):
 
     self.store = TagStore()
     self.last_updated = None
+    self.revision = None
     self._tries = 0
     self._calls = []
+    self._updating = False
+    self._update_requested = False
 
     self._extensions = []
 
     self._update_funcs = []
+    self._count_funcs = []
     self._cleanup_funcs = []
 
 
@@ -160,6 +166,9 @@ class GtkUI(GtkPluginBase):
 
       self._load_extensions()
 
+      client.register_event_handler("TaggingChangedEvent",
+        self._on_tagging_changed)
+
       log.info("%s initialized", self.__class__.__name__)
     except:
       log.error("Error initializing %s", self.__class__.__name__)
@@ -191,9 +200,13 @@ class GtkUI(GtkPluginBase):
 
     tagging.common.cancel_calls(self._calls)
 
+    client.deregister_event_handler("TaggingChangedEvent",
+      self._on_tagging_changed)
+
     self._run_cleanup_funcs()
     self._unload_extensions()
     self._update_funcs = []
+    self._count_funcs = []
 
     self._close_config()
     self._destroy_store()
@@ -258,6 +271,19 @@ class GtkUI(GtkPluginBase):
       self._update_funcs.remove(func)
 
 
+  # Count funcs run instead of update funcs when only tag counts changed
+  def register_count_func(self, func):
+
+    if func not in self._count_funcs:
+      self._count_funcs.append(func)
+
+
+  def deregister_count_func(self, func):
+
+    if func in self._count_funcs:
+      self._count_funcs.remove(func)
+
+
   def register_cleanup_func(self, func):
 
     if func not in self._cleanup_funcs:
@@ -336,12 +362,26 @@ class GtkUI(GtkPluginBase):
 
   # Section: Update
 
+  def _on_tagging_changed(self, revision):
+
+    if not self.initialized or revision == self.revision:
+      return
+
+    if self._updating:
+      self._update_requested = True
+    else:
+      tagging.common.cancel_calls(self._calls)
+      self._update_loop()
+
+
   def _update_loop(self):
 
     def on_timeout():
 
       log.error("%s: %s", STR_UPDATE, TaggingError(ERR_TIMED_OUT))
 
+      self._updating = False
+
       if self.initialized:
         self._tries += 1
         if self._tries < MAX_TRIES:
@@ -353,6 +393,8 @@ class GtkUI(GtkPluginBase):
 
     def process_result(result):
 
+      self._updating = False
+
       if isinstance(result, Failure):
         if (isinstance(result.value, DelugeRPCError) and
             result.value.exception_type == "TaggingError"):
@@ -363,7 +405,7 @@ class GtkUI(GtkPluginBase):
           return result
       else:
         self._tries = 0
-        interval = UPDATE_INTERVAL
+        interval = 0 if self._update_requested else UPDATE_INTERVAL
         self._update_store(result)
 
       if self.initialized:
@@ -374,8 +416,10 @@ class GtkUI(GtkPluginBase):
     tagging.common.clean_calls(self._calls)
 
     if self.initialized:
-      pickled_time = cPickle.dumps(self.last_updated)
-      deferred = client.tagging.get_tag_updates(pickled_time)
+      self._updating = True
+      self._update_requested = False
+
+      deferred = client.tagging.get_tag_updates(self.revision)
       tagging.common.deferred_timeout(deferred, REQUEST_TIMEOUT, on_timeout,
         process_result, process_result)
 
@@ -387,13 +431,27 @@ class GtkUI(GtkPluginBase):
 
     update = cPickle.loads(result)
 
-    log.debug("Update: Type: %s, Timestamp: %s", update.type,
-      update.timestamp)
+    log.debug("Update: Type: %s, Timestamp: %s, Revision: %s", update.type,
+      update.timestamp, update.revision)
 
     self.last_updated = update.timestamp
-    self.store.update(update.data)
+    self.revision = update.revision
+
+    funcs = self._update_funcs
+
+    if update.type == TagUpdate.TYPE_DELTA:
+      if not update.data["tags"] and not update.data["removed"]:
+        if not update.data["counts"]:
+          return
+
+        # The tree is unchanged, so only views showing counts need a redraw
+        funcs = self._count_funcs
+
+      self.store.apply_delta(update.data)
+    else:
+      self.store.update(update.data)
 
-    for func in list(self._update_funcs):
+    for func in list(funcs):
       try:
         func(self.store)
       except: